@@ -3,7 +3,11 @@
 import calendar
 from argparse import ArgumentParser
 from datetime import date
+import concurrent.futures
+import logging
+import os
 import re
+import subprocess
 import sys
 
 ap = ArgumentParser(prog="""bb = batch builder (inspired by DRS!)
@@ -16,30 +20,149 @@ example output:
     /home/osc/proj/ingest/bin/oai-harvest.py -u "'https://www.ncbi.nlm.nih.gov/pmc/oai/oai.cgi?verb=ListRecords&metadataPrefix=pmc_fm&from=2014-04-01&until=2014-04-30&set=pmc-open#" -d "/home/osc/proj/pmc/data/batch/pmc2014_04.2014_05_09/oai";
     /home/osc/proj/pmc/bin/pmc2dash.py pmc2014_04.2014_05_09;
     rsync -avz /home/osc/proj/pmc/data/batch/pmc2014_04.2014_05_09/import dspace@byrd.lib.harvard.edu:/home/dspace/import/pmc2014_04.2014_05_09/;
+
+with --through, does the same for every month up to and including that one.
+with --run, runs the steps itself instead, at most --jobs steps at a time: the months
+harvest side by side, pmc2dash takes them in month order as their harvests finish,
+and each month is packaged as soon as its pmc2dash run is done.
 """)
 
 ap.add_argument("year_month", type=lambda x: x.split("_"), help="full year and zero-padded month, separated by an underscore, e.g. 2017_03")
+ap.add_argument("--through", type=lambda x: x.split("_"), metavar="YEAR_MONTH", help="last month of a backfill range, e.g. 2017_12 (default: year_month only)")
+ap.add_argument("--run", action="store_true", help="run the batches instead of printing the commands")
+ap.add_argument("--jobs", type=int, default=3, metavar="N", help="with --run, steps running at once across all months (default: %(default)s)")
+ap.add_argument("--archive", choices=("tar", "tar.gz", "tar.zst", "zip"), help="have pmc2dash write one archive per collection, so packaging copies a few large files")
+ap.add_argument("--workers", type=int, default=1, metavar="N", help="with --run, pmc2dash --workers for each month (default: %(default)s)")
 
-def main() :
-    args= ap.parse_args()
-    year, month = args.year_month
+LOG = logging.getLogger('bb')
+
+osc_root = "/home/osc"
+pmc_proj_dir  = osc_root + "/proj/pmc"
+
+# later steps of a month go first, so finished months get packaged while others are still harvesting.
+STEP_PRIORITY = {'package': 0, 'pmc2dash': 1, 'harvest': 2}
+
+
+def months(first, last):
+    '''(year, month) strings from first to last inclusive.'''
+    year, month = int(first[0]), int(first[1])
+    while (year, month) <= (int(last[0]), int(last[1])) :
+        yield str(year), "{:02d}".format(month)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
 
+
+def month_batch(year, month, batch_run_date):
     batch_start_date = "{}-{}-01".format(year, month)
     batch_end_date   = "{}-{}-{}".format(year, month, str(calendar.monthrange(int(year),int(month))[1]))
-    batch_run_date=str(date.today()).replace("-","_")
     batch_id = "pmc{}_{}.{}".format(year, month, batch_run_date)
 
-    osc_root = "/home/osc"
-    pmc_proj_dir  = osc_root + "/proj/pmc"
     pmc_batch_dir = pmc_proj_dir + "/data/batch/" + batch_id
-    pmc_oai_dir   = pmc_batch_dir + "/oai"
 
-    pmc_oai_url   = 'https://www.ncbi.nlm.nih.gov/pmc/oai/oai.cgi?verb=ListRecords&metadataPrefix=pmc_fm&from=' + batch_start_date + '&until=' + batch_end_date + '&set=pmc-open#'
-    pmc_sip_dir   = pmc_batch_dir + "/import"
+    return {'id': batch_id,
+            'dir': pmc_batch_dir,
+            'oai_dir': pmc_batch_dir + "/oai",
+            'oai_url': 'https://www.ncbi.nlm.nih.gov/pmc/oai/oai.cgi?verb=ListRecords&metadataPrefix=pmc_fm&from=' + batch_start_date + '&until=' + batch_end_date + '&set=pmc-open#',
+            'sip_dir': pmc_batch_dir + "/import"}
+
+
+def pmc2dash_options(archive):
+    return ["--archive", archive] if archive else []
+
+
+def print_batch(batch, archive):
+    print("mkdir -p " + batch['oai_dir'] + ";")
+    print(osc_root + '/proj/ingest/bin/oai-harvest.py -u "' + batch['oai_url'] + '" -d "' + batch['oai_dir'] + '";')
+    print(" ".join([pmc_proj_dir + "/bin/pmc2dash.py", batch['id']] + pmc2dash_options(archive)) + ";")
+    print("rsync -avz " + batch['sip_dir'] + " dspace@byrd.lib.harvard.edu:/home/dspace/import/" + batch['id'] + "/;")
+
+
+def batch_tasks(batches, workers, archive):
+    '''The backfill dag: harvest -> pmc2dash -> package for every month.
+
+    Harvests have no dependencies, so months download side by side, --jobs at a time.
+    Only the pmc2dash runs chain, in month order, so that each run finds the previous months' articles in the
+    shared dash holdings index (--update-dash-index) and authority cache, as hand-sequenced runs did.'''
+    tasks = {}
+    previous = None
+    for batch in batches :
+        harvest = (batch['id'], 'harvest')
+        pmc2dash = (batch['id'], 'pmc2dash')
+        package = (batch['id'], 'package')
+        tasks[harvest] = {'deps': [], 'batch': batch,
+                          'argv': [sys.executable, pmc_proj_dir + '/bin/oaiharvest.py', batch['oai_url'], '-d', batch['oai_dir']]}
+        tasks[pmc2dash] = {'deps': [harvest] + ([previous] if previous else []), 'batch': batch,
+                           'argv': [sys.executable, pmc_proj_dir + '/bin/pmc2dash.py', batch['id'], '--update-dash-index', '--workers', str(workers), '--quiet'] + pmc2dash_options(archive)}
+        tasks[package] = {'deps': [pmc2dash], 'batch': batch,
+                          'argv': ['rsync', '-avz', batch['sip_dir'], 'dspace@byrd.lib.harvard.edu:/home/dspace/import/' + batch['id'] + '/']}
+        previous = pmc2dash
+    return tasks
+
+
+def run_step(name, task):
+    '''Run one step, with its output going to the batch's logs directory.'''
+    batch_id, step = name
+    log_dir = os.path.join(task['batch']['dir'], 'logs')
+    os.makedirs(task['batch']['oai_dir'], exist_ok=True)
+    os.makedirs(log_dir, exist_ok=True)
+    log_path = os.path.join(log_dir, step + '.log')
+    LOG.info("%s: %s started", batch_id, step)
+    with open(log_path, 'w') as log_file :
+        subprocess.run(task['argv'], stdout=log_file, stderr=subprocess.STDOUT, check=True)
+    LOG.info("%s: %s done", batch_id, step)
+
+
+def run_dag(tasks, jobs):
+    '''Run each task once its dependencies have succeeded, at most jobs at a time.
+
+    Tasks downstream of a failure are skipped; returns the final state of every task.'''
+    state = {name: 'waiting' for name in tasks}
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor :
+        while True :
+            ready = []
+            # tasks are in dependency order, so one pass settles every skip.
+            for name, task in tasks.items() :
+                if state[name] != 'waiting' :
+                    continue
+                dep_states = [state[dep] for dep in task['deps']]
+                if any(dep_state in ('failed', 'skipped') for dep_state in dep_states) :
+                    state[name] = 'skipped'
+                    LOG.warning("%s: %s skipped", *name)
+                elif all(dep_state == 'done' for dep_state in dep_states) :
+                    ready.append(name)
+            ready.sort(key=lambda name: STEP_PRIORITY[name[1]])
+            for name in ready[:jobs - len(running)] :
+                state[name] = 'running'
+                running[executor.submit(run_step, name, tasks[name])] = name
+            if not running :
+                return state
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished :
+                name = running.pop(future)
+                try:
+                    future.result()
+                    state[name] = 'done'
+                except (OSError, subprocess.CalledProcessError) as e:
+                    state[name] = 'failed'
+                    LOG.error("%s: %s failed: %s (see %s/logs/%s.log)", name[0], name[1], e, tasks[name]['batch']['dir'], name[1])
+
+
+def main() :
+    args= ap.parse_args()
+    batch_run_date=str(date.today()).replace("-","_")
+    batches = [month_batch(year, month, batch_run_date) for year, month in months(args.year_month, args.through or args.year_month)]
+
+    if not args.run :
+        for batch in batches :
+            print_batch(batch, args.archive)
+        return
 
-    print("mkdir -p " + pmc_oai_dir + ";")
-    print(osc_root + '/proj/ingest/bin/oai-harvest.py -u "' + pmc_oai_url + '" -d "' + pmc_oai_dir + '";')
-    print( pmc_proj_dir + "/bin/pmc2dash.py " + batch_id +";")
-    print("rsync -avz " + pmc_sip_dir + " dspace@byrd.lib.harvard.edu:/home/dspace/import/" + batch_id + "/;")
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    state = run_dag(batch_tasks(batches, args.workers, args.archive), max(1, args.jobs))
+    failed = [name for name, task_state in state.items() if task_state != 'done']
+    for batch in batches :
+        LOG.info("%s: %s", batch['id'], ", ".join("{} {}".format(step, state[(batch['id'], step)]) for step in ('harvest', 'pmc2dash', 'package')))
+    if failed :
+        sys.exit(1)
 
 main()
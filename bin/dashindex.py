@@ -0,0 +1,173 @@
+#!/bin/env python3
+
+# prebuilt index of dash holdings (dois, pmcids, titles) for pmc2dash duplicate detection.
+# the index is a sorted array of 64 bit hashes, memory mapped and binary searched,
+# so loading it costs next to nothing however many items dash holds.
+# the header records a digest of the files the bulklib dash loaders read, so that pmc2dash
+# can tell when dash has changed underneath the index and rebuild it.
+
+import sys, os
+
+import argparse, array, bisect, hashlib, mmap, re, tempfile, unicodedata
+
+MAGIC = b'DASHIDX2'
+SOURCE_SIZE = 32
+HEADER_SIZE = 16 + SOURCE_SIZE # magic + key count + source digest
+
+KINDS = ('doi', 'pmcid', 'title')
+
+
+def default_index_path():
+    return os.path.join(os.environ['OSCROOT'], 'proj/pmc/data/cache/dash-holdings.idx')
+
+
+def source_signature(bulklib):
+    '''mtime and size of bulklib and of the ingest tsv files, which the bulklib loaders read.'''
+    paths = [getattr(bulklib, '__file__', None)]
+    tsv_dir = os.path.join(os.environ['OSCROOT'], 'proj/ingest/data/tsv')
+    if os.path.isdir(tsv_dir) :
+        paths.extend(os.path.join(tsv_dir, name) for name in sorted(os.listdir(tsv_dir)))
+    signature = []
+    for path in paths :
+        if path and os.path.isfile(path) :
+            stat = os.stat(path)
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+    return signature
+
+
+def source_digest(signature):
+    return hashlib.sha256(repr(signature).encode('utf-8')).digest()
+
+
+def normalize_title(title):
+    '''Fold case, accents, punctuation and whitespace so near-identical titles compare equal.'''
+    title = unicodedata.normalize('NFKD', title)
+    title = "".join(c for c in title if not unicodedata.combining(c))
+    title = re.sub(r"[\W_]+", " ", title.casefold())
+    return title.strip()
+
+
+def normalize(kind, value):
+    value = value.strip()
+    if kind == 'title' :
+        return normalize_title(value)
+    if kind == 'pmcid' :
+        return re.sub("^pmc", "", value.lower())
+    # dois are case insensitive.
+    return value.lower()
+
+
+def holding_key(kind, value):
+    '''64 bit hash of a normalized holding. Collisions are negligible at the size of dash.'''
+    digest = hashlib.blake2b((kind + "\0" + normalize(kind, value)).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def holding_keys(entries):
+    '''Hash (kind, value) pairs, skipping empty values.'''
+    return (holding_key(kind, value) for kind, value in entries if value and normalize(kind, value))
+
+
+def write_index(path, keys, source=bytes(SOURCE_SIZE)):
+    '''Write keys, sorted and deduplicated, to path atomically, with the digest of the sources they came from.'''
+    keys = array.array('Q', sorted(set(keys)))
+    index_dir = os.path.dirname(path)
+    if index_dir and not os.path.exists(index_dir) :
+        os.makedirs(index_dir)
+    fd, tmppath = tempfile.mkstemp(suffix='.tmp', dir=index_dir or '.')
+    with os.fdopen(fd, 'wb') as f :
+        f.write(MAGIC)
+        f.write(len(keys).to_bytes(8, 'little'))
+        f.write(source)
+        keys.tofile(f)
+    os.chmod(tmppath, 0o644)
+    os.replace(tmppath, path)
+    return len(keys)
+
+
+def build_index(path, dois, titles, pmcids, source=bytes(SOURCE_SIZE)):
+    '''Build the index from scratch out of the dash doi, title and pmcid sets.'''
+    entries = [('doi', doi) for doi in dois]
+    entries.extend(('title', title) for title in titles)
+    entries.extend(('pmcid', pmcid) for pmcid in pmcids)
+    return write_index(path, holding_keys(entries), source)
+
+
+def update_index(path, entries):
+    '''Add (kind, value) pairs to an existing index without going back to the dash sources.'''
+    index = open_index(path)
+    keys = list(index['keys'])
+    source = index['source']
+    close_index(index)
+    keys.extend(holding_keys(entries))
+    # the additions do not make the index any more current with the sources.
+    return write_index(path, keys, source)
+
+
+def open_index(path):
+    with open(path, 'rb') as f :
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[:len(MAGIC)] != MAGIC :
+        mm.close()
+        raise ValueError("not a dash holdings index: " + path)
+    count = int.from_bytes(mm[len(MAGIC):len(MAGIC) + 8], 'little')
+    keys = memoryview(mm)[HEADER_SIZE:HEADER_SIZE + count * 8].cast('Q')
+    return {'path': path, 'mmap': mm, 'keys': keys, 'source': mm[len(MAGIC) + 8:HEADER_SIZE]}
+
+
+def close_index(index):
+    index['keys'].release()
+    index['mmap'].close()
+
+
+def contains(index, kind, value):
+    if not value :
+        return False
+    key = holding_key(kind, value)
+    keys = index['keys']
+    i = bisect.bisect_left(keys, key)
+    return i < len(keys) and keys[i] == key
+
+
+def read_entries(f):
+    '''Read kind<TAB>value lines, e.g. "doi	10.1371/journal.pone.0067405".'''
+    for line in f :
+        line = line.rstrip("\n")
+        if not line.strip() :
+            continue
+        kind, value = line.split("\t", 1)
+        if kind not in KINDS :
+            raise ValueError("unknown holding kind: " + kind)
+        yield kind, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''Build or update the dash holdings index used by pmc2dash for duplicate detection.''')
+    parser.add_argument('--index', default=None, metavar='PATH', help='index file (default: $OSCROOT/proj/pmc/data/cache/dash-holdings.idx)')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    subparsers.add_parser('build', help='rebuild the index from the bulklib dash doi, title and pmcid loaders')
+    update_parser = subparsers.add_parser('update', help='add newly loaded items, read as kind<TAB>value lines (kind is doi, pmcid or title)')
+    update_parser.add_argument('files', nargs='*', metavar='FILE', help='files of kind<TAB>value lines (default: stdin)')
+    args = parser.parse_args()
+    path = args.index or default_index_path()
+
+    if args.command == 'build' :
+        sys.path.append(os.path.join(os.environ['OSCROOT'], 'proj/ingest/lib'))
+        import bulklib
+        count = build_index(path, bulklib.load_dash_dois(), bulklib.load_dash_titles(), bulklib.load_dash_pmcids(),
+                            source_digest(source_signature(bulklib)))
+    else :
+        entries = []
+        for name in args.files or ['-'] :
+            if name == '-' :
+                entries.extend(read_entries(sys.stdin))
+            else :
+                with open(name, encoding='utf-8') as f :
+                    entries.extend(read_entries(f))
+        count = update_index(path, entries)
+    print("{}: {} holdings".format(path, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/bin/env python3
+
+# oai-pmh ListRecords harvester for pmc2dash.
+# follows resumptionTokens, archiving each page gzipped as it arrives, and hands pages out
+# while the next one downloads, so that a caller can process the harvest as it goes.
+# harvest.json in the page directory records how far a harvest got, so that an interrupted one can be resumed.
+
+import sys, os
+
+import argparse, glob, gzip, io, json, logging, queue, threading, time
+import http.client
+import urllib.error, urllib.parse, urllib.request
+from lxml import etree
+
+LOG = logging.getLogger('pmc2dash.harvest')
+
+PAGE_NAME = 'page{:05d}.xml.gz'
+STATE_NAME = 'harvest.json'
+
+SETTINGS = {'timeout': 300,
+            'retries': 5,
+            'backoff': 10,
+            'prefetch': 1}
+
+
+def page_url(url, token):
+    '''The ListRecords url for a resumption token: the base url with only the verb and the token.'''
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.urlencode({'verb': 'ListRecords', 'resumptionToken': token})
+    return urllib.parse.urlunsplit((parts.scheme, parts.netloc, parts.path, query, ''))
+
+
+def fetch_page(url):
+    '''GET one page, retrying on errors, and honoring Retry-After on 503 the way oai-pmh servers use it.'''
+    for attempt in range(SETTINGS['retries'] + 1) :
+        try:
+            with urllib.request.urlopen(url, timeout=SETTINGS['timeout']) as response :
+                return response.read()
+        except (urllib.error.URLError, OSError, http.client.HTTPException) as e:
+            client_error = isinstance(e, urllib.error.HTTPError) and e.code < 500
+            if client_error or attempt == SETTINGS['retries'] :
+                raise
+            delay = SETTINGS['backoff'] * 2 ** attempt
+            retry_after = getattr(e, 'headers', None) and e.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit() :
+                delay = int(retry_after)
+            LOG.warning("harvest request failed (%s), retrying in %ds: %s", e, delay, url)
+            time.sleep(delay)
+
+
+def resumption_token(page):
+    '''The resumptionToken of a page, or None on the last page. Raises ValueError on an oai-pmh error.'''
+    token = None
+    for event, node in etree.iterparse(io.BytesIO(page), tag=('{*}resumptionToken', '{*}error')) :
+        if etree.QName(node).localname == 'error' :
+            if node.get('code') == 'noRecordsMatch' :
+                return None
+            raise ValueError("oai-pmh error {}: {}".format(node.get('code'), node.text))
+        token = (node.text or '').strip() or None
+    return token
+
+
+def read_state(oai_dir):
+    '''The progress of the last harvest into oai_dir: url, pages archived, next resumptionToken and
+    whether the tokens ran out. None if the pages were not harvested by this module.'''
+    path = os.path.join(oai_dir, STATE_NAME)
+    if not os.path.exists(path) :
+        return None
+    with open(path) as f :
+        return json.load(f)
+
+
+def write_state(oai_dir, state):
+    path = os.path.join(oai_dir, STATE_NAME)
+    with open(path + '.part', 'w') as f :
+        json.dump(state, f)
+    os.replace(path + '.part', path)
+
+
+def harvest_complete(oai_dir):
+    '''False if the last harvest into oai_dir stopped before its resumptionTokens ran out.'''
+    state = read_state(oai_dir)
+    return state is None or state['complete']
+
+
+def harvest_pages(url, oai_dir, resume=False):
+    '''Download a ListRecords harvest into oai_dir, one page at a time, until the resumptionTokens run out.
+
+    Yields each archived page path; the next page is already downloading while the caller works on it.
+    Pages left over from an earlier harvest are removed first, unless resume is set: then the pages of an
+    unfinished harvest of the same url are yielded again and the harvest goes on from its last resumptionToken.'''
+    if not os.path.exists(oai_dir) :
+        os.makedirs(oai_dir)
+    state = read_state(oai_dir) if resume else None
+    if state is not None and state['url'] != url :
+        raise ValueError("{} holds a harvest of {}, not {}".format(oai_dir, state['url'], url))
+    if state is None :
+        for stale in glob.glob(os.path.join(oai_dir, '*.xml')) + glob.glob(os.path.join(oai_dir, '*.xml.gz')) + [os.path.join(oai_dir, STATE_NAME)] :
+            if os.path.exists(stale) :
+                os.remove(stale)
+        state = {'url': url, 'pages': 0, 'token': None, 'complete': False}
+    elif state['pages'] :
+        LOG.info("resuming harvest after page %d", state['pages'] - 1)
+
+    for number in range(state['pages']) :
+        yield os.path.join(oai_dir, PAGE_NAME.format(number))
+    if state['complete'] :
+        return
+
+    pages = queue.Queue(SETTINGS['prefetch'])
+    threading.Thread(target=download_pages, args=(state, oai_dir, pages), daemon=True).start()
+    while True :
+        item = pages.get()
+        if item is None :
+            return
+        if isinstance(item, Exception) :
+            raise item
+        yield item
+
+
+def download_pages(state, oai_dir, pages):
+    '''Harvester thread: fetch and archive pages from where state left off, recording each one in harvest.json
+    and handing its path to the pages queue, then None.'''
+    try:
+        while not state['complete'] :
+            number = state['pages']
+            url = page_url(state['url'], state['token']) if state['token'] else state['url']
+            LOG.info("harvesting page %d: %s", number, url)
+            page = fetch_page(url)
+            token = resumption_token(page)
+            path = os.path.join(oai_dir, PAGE_NAME.format(number))
+            with gzip.open(path + '.part', 'wb') as f :
+                f.write(page)
+            os.replace(path + '.part', path)
+            state.update(pages=number + 1, token=token, complete=token is None)
+            write_state(oai_dir, state)
+            pages.put(path)
+        pages.put(None)
+    except Exception as e:
+        pages.put(e)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''Harvest an oai-pmh ListRecords request into gzipped pages.''')
+    parser.add_argument('url', help='ListRecords url, e.g. https://www.ncbi.nlm.nih.gov/pmc/oai/oai.cgi?verb=ListRecords&metadataPrefix=pmc_fm&from=2017-03-01&until=2017-03-31&set=pmc-open')
+    parser.add_argument('-d', '--dir', required=True, help='directory for the harvested pages')
+    parser.add_argument('--timeout', type=float, default=SETTINGS['timeout'], metavar='SECONDS', help='timeout per page request (default: %(default)s)')
+    parser.add_argument('--retries', type=int, default=SETTINGS['retries'], metavar='N', help='retries per failed page request (default: %(default)s)')
+    parser.add_argument('--resume', action='store_true', help='continue an interrupted harvest of the same url from its last resumptionToken instead of starting over')
+    args = parser.parse_args()
+    SETTINGS['timeout'] = args.timeout
+    SETTINGS['retries'] = args.retries
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    count = 0
+    for path in harvest_pages(args.url, args.dir, args.resume) :
+        count += 1
+    print("{}: {} pages".format(args.dir, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -12,129 +12,849 @@ OSCROOT=os.environ['OSCROOT'] #/home/osc
 sys.path.append(os.path.join(OSCROOT, 'proj/ingest/lib'))
 sys.path.append(os.path.join(OSCROOT, 'common/lib/python3'))
 
-import argparse, glob, json, random, re, shutil, bulklib, time, tsv
-import urllib.request, urllib.parse, urllib.error
-from pprint import pprint
+import argparse, concurrent.futures, contextlib, cProfile, dashindex, fcntl, functools, glob, gzip, hashlib, json, logging, multiprocessing, oaiharvest, pickle, re, shutil, sqlite3, bulklib, tarfile, tempfile, threading, time, tsv, zipfile
+import http.client, urllib.request, urllib.parse, urllib.error
+from pprint import pformat
 from lxml import etree
 
+try:
+    import zstandard
+except ImportError:
+    # only needed for --archive tar.zst.
+    zstandard = None
+
 AUTHORITY_REPORT=[]
 
+# one logger per pipeline area, so debug output can be narrowed to the part being looked at.
+LOG           = logging.getLogger('pmc2dash')
+EXTRACT_LOG   = logging.getLogger('pmc2dash.extract')
+SCHOOL_LOG    = logging.getLogger('pmc2dash.schools')
+AUTHORITY_LOG = logging.getLogger('pmc2dash.authority')
+DOWNLOAD_LOG  = logging.getLogger('pmc2dash.download')
+OUTPUT_LOG    = logging.getLogger('pmc2dash.output')
+
 DATA_DIR = os.path.join(OSCROOT, "proj/pmc/data")
+
+# run options from the command line, handed to worker processes by init_worker.
+SETTINGS = {'log_level': 'INFO',
+            'check_prescreen': False,
+            'extractor': 'xpath',
+            'check_extractor': False,
+            'check_citations': False,
+            'authority_url': 'https://dash.harvard.edu/getBestMatch',
+            'authority_concurrency': 8,
+            'authority_timeout': 30,
+            'authority_retries': 3,
+            'authority_backoff': 2,
+            'authority_cache': os.path.join(DATA_DIR, 'cache', 'authorities.sqlite'),
+            'authority_cache_ttl': 30,
+            'authority_cache_size': 500000,
+            'refresh_authorities': False,
+            'download_concurrency': 2,
+            'download_rate': 0.25,
+            'download_burst': 1,
+            'download_timeout': 120,
+            'article_store': os.path.join(DATA_DIR, 'store'),
+            'article_store_size': 200,
+            'link_mode': 'copy',
+            'archive': None,
+            'dash_index': os.path.join(DATA_DIR, 'cache', 'dash-holdings.idx'),
+            'incremental': False,
+            'batch': None,
+            'fingerprints': os.path.join(DATA_DIR, 'cache', 'fingerprints.sqlite'),
+            'pmcid2dashid_index': os.path.join(DATA_DIR, 'cache', 'pmcid2dashid.sqlite'),
+            'reference_cache': os.path.join(DATA_DIR, 'cache', 'reference'),
+            'refresh_reference': False,
+            'shard': None}
+
+# per process thread pool and per thread keep-alive connections for getBestMatch lookups.
+AUTHORITY_EXECUTOR = None
+AUTHORITY_CONNECTIONS = threading.local()
+AUTHORITY_CACHE_DB = None
+
+# per process connection to the --incremental record fingerprint store.
+FINGERPRINT_DB = None
+
+# pdf downloads share one token bucket so that concurrent fetches stay polite to ncbi.
+DOWNLOAD_EXECUTOR = None
+DOWNLOAD_BUCKET = {'lock': threading.Lock(), 'tokens': 0, 'stamp': None}
+
+# per thread connections to the index of the article store, which download threads look files up in.
+ARTICLE_STORE_CONNECTIONS = threading.local()
+
 UNAFFILIATED = 'UNAFFILIATED'
 
-DASH2LDAP_SCHOOL = bulklib.load_dash2ldap_school()
-LDAP2DASH_SCHOOL = {v:k for k, v in DASH2LDAP_SCHOOL.items()}
+# bulklib reference data, loaded on first use (see reference_data). bump the version when the snapshot layout changes.
+REFERENCE_DATA = {}
+REFERENCE_SIGNATURE = None
+REFERENCE_SNAPSHOT_VERSION = 1
+
+# affiliation patterns in order of precedence. harvard university goes to FAS only when a fas department matches too.
+# does changing HSPH to SPH matter here?
+SCHOOL_PATTERNS = (
+    ('HMS', "harvard medical school|harvard university school of medicine|beth israel deaconess medical center|brigham and women’s hospital|massachusetts general hospital"),
+    ('SPH', "harvard school of public health"),
+    ('GSE', "harvard graduate school of education"),
+    ('FAS', "harvard university"),
+    ('',    "harvard"),
+)
+HARVARD_EMAIL_RE = re.compile(r"harvard\.edu")
+
+# patterns for the per article text cleanup, compiled once.
+WHITESPACE_RE = re.compile(r"\s+")
+SPACES_RE = re.compile(r" +")
+OTHER_TYPE_RE = re.compile(r"Poster Presentation|Editorial")
+HEADING_SUBJECT_RE = re.compile(r"Research|Letter|Communication|Dispatch|Tools|Original Research|\d+")
+SUBJECT_CODE_RE = re.compile(r"^\(\d+\.\d+\)")
+ABSTRACT_HEADING_RE = re.compile(
+    r"(" + r"|".join(
+        (r"Author Summary", r"Background", r"Case presentation", r"Conclusion", r"Conclusions", r"Conclusions\/Significance",
+         r"Design", "eLife digest", "Findings", "IMPORTANCE", "Introduction",
+         r"Main Outcome Measures?", r"Main Results", r"Methods(?: (?:&|and) (?:(?:(?:Principal )?Findings)|Results))?", r"Methods\/Findings",
+         r"Objectives?", r"Participants", r"Rationale", r"Research Design & Methods", r"Results", "Setting(?: and Participants)?",)
+    ) + r")$")
+CITATION_CLEANUPS = ((re.compile(r", \."), "."), (re.compile(r"\.\."), "."), (WHITESPACE_RE, " "), (re.compile(r"\?\."), "?"))
+CITATION_TRAILING_COMMA_RE = re.compile(r", $")
+CITATION_SPACE_COMMA_RE = re.compile(r" ,")
+AFF_LABEL_RE = re.compile(r"^[ß1234567890]")
+# aff text scrubbed before it is matched against the ldap title field, in this order.
+TITLE_SCRUBS = tuple(re.compile(pattern) for pattern in (
+    r"broad institute of harvard and massachusetts institute of technology",
+    r"broad institute of harvard",
+    r"massachusetts institute of technology",
+    r"harvard|\d+|cambridge|massachusetts|\,|hospital|united states of america|department of|boston|huntington|avenue|kresge| ma | usa|brigham and women\’s|medical school",
+    r"school of [^,]+",
+))
+
+# citations checked against tweaked dash crossref api output by --check-citations.
+CITATION_CHECKS = {
+    '10.2337/dc11-2420': "Beer, N. L., K. K. Osbak, M. van de Bunt, N. D. Tribble, A. M. Steele, K. J. Wensley, E. L. Edghill, et al. 2012. “Insights Into the Pathogenicity of Rare Missense GCK Variants From the Identification and Functional Characterization of Compound Heterozygous and Double Mutations Inherited in Cis.” Diabetes Care 35 (7): 1482-1484. doi:10.2337/dc11-2420. http://dx.doi.org/10.2337/dc11-2420.",
+    '10.2337/dc12-0073': "Cozma, A. I., J. L. Sievenpiper, R. J. de Souza, L. Chiavaroli, V. Ha, D. D. Wang, A. Mirrahimi, et al. 2012. “Effect of Fructose on Glycemic Control in Diabetes: A systematic review and meta-analysis of controlled feeding trials.” Diabetes Care 35 (7): 1611-1620. doi:10.2337/dc12-0073. http://dx.doi.org/10.2337/dc12-0073.",
+    '10.1186/2045-5380-3-12': "Huys, Quentin JM, Diego A Pizzagalli, Ryan Bogdan, and Peter Dayan. 2013. “Mapping anhedonia onto reinforcement learning: a behavioural meta-analysis.” Biology of Mood & Anxiety Disorders 3 (1): 12. doi:10.1186/2045-5380-3-12. http://dx.doi.org/10.1186/2045-5380-3-12.",
+    '10.2337/db11-0134': "Azzi, J., R. F. Moore, W. Elyaman, M. Mounayar, N. El Haddad, S. Yang, M. Jurewicz, et al. 2012. “The Novel Therapeutic Effect of Phosphoinositide 3-Kinase-γ Inhibitor AS605240 in Autoimmune Diabetes.” Diabetes 61 (6): 1509-1518. doi:10.2337/db11-0134. http://dx.doi.org/10.2337/db11-0134.",
+    '10.2337/db11-1296': "Haiman, C. A., M. D. Fesinmeyer, K. L. Spencer, P. Bůžková, V. S. Voruganti, P. Wan, J. Haessler, et al. 2012. “Consistent Directions of Effect for Established Type 2 Diabetes Risk Variants Across Populations: The Population Architecture using Genomics and Epidemiology (PAGE) Consortium.” Diabetes 61 (6): 1642-1647. doi:10.2337/db11-1296. http://dx.doi.org/10.2337/db11-1296.",
+    '10.1371/journal.pone.0067405': "Palmsten, Kristin, Krista F. Huybrechts, Helen Mogun, Mary K. Kowal, Paige L. Williams, Karin B. Michels, Soko Setoguchi, and Sonia Hernández-Díaz. 2013. “Harnessing the Medicaid Analytic eXtract (MAX) to Evaluate Medications in Pregnancy: Design Considerations.” PLoS ONE 8 (6): e67405. doi:10.1371/journal.pone.0067405. http://dx.doi.org/10.1371/journal.pone.0067405.",
+    '10.1111/nyas.12031': "Weir, Gordon C., and Susan Bonner-Weir. 2013. “Islet β cell mass in diabetes and how it relates to function, birth, and death.” Annals of the New York Academy of Sciences 1281 (1): 92-105. doi:10.1111/nyas.12031. http://dx.doi.org/10.1111/nyas.12031.",
+    '10.4081/hi.2011.e14': "Huffman, Jeff C., Carol A. Mastromauro, Julia K. Boehm, Rita Seabrook, Gregory L. Fricchione, John W. Denninger, and Sonja Lyubomirsky. 2011. “Development of a positive psychology intervention for patients with acute cardiovascular disease.” Heart International 6 (2): e14. doi:10.4081/hi.2011.e14. http://dx.doi.org/10.4081/hi.2011.e14.",
+}
+
+# pipeline stages timed into metrics.json.
+STAGES = ('page_parse', 'prescreen', 'extraction', 'school_assignment', 'authority_lookup', 'download', 'output_write')
+
+# open --archive archives, by collection.
+OUTPUT_ARCHIVES = {}
+
+# ioctl giving the target file the source's extents, copy on write (btrfs, xfs and the like).
+FICLONE = 0x40049409
+
+HARVARD_TOKEN = b'harvard'
+HARVARD_AVE_TOKEN = b'harvard ave'
+
+# oai pages are fed to the parser in pieces ending with a record, so each piece can be prescreened.
+RECORD_END = b'</record>'
+PAGE_READ_SIZE = 1 << 20
 
 OAI_NS = None
 ARTICLE_NS = None
+ARTICLE_XPATHS = {}
 
 def main():
     parser = argparse.ArgumentParser(description='''Processor for pubmed central (pmc) batch.
     1. read batch input files
     2. for each Harvard match, create a dc file
     3. spit out to batch specific output directory.''')
-    parser.add_argument('batch', metavar='BATCH', help='name of the base directory for the batch')
+    parser.add_argument('batch', metavar='BATCH', nargs='+', help='name of the base directory for the batch (several with --survey)')
+    parser.add_argument('--survey', action='store_true', help='only count harvard records and their pmc schools and fas departments, for planning: no author lookups, downloads or import output; writes report/survey.json per batch')
+    parser.add_argument('--shard', type=parse_shard, metavar='I/N', help='process only the records whose pmcid hashes to shard I of N (0 based), into shards/I/ under the batch directory, so hosts sharing the filesystem can split a batch')
+    parser.add_argument('--merge-shards', type=int, metavar='N', help='combine the finished runs of shards 0..N-1 into the batch import directory, report and author report, renumbering the articles')
+    parser.add_argument('--check-prescreen', action='store_true', help='run the full aff check on every record and report where the byte prescreen disagrees')
+    parser.add_argument('--extractor', default=SETTINGS['extractor'], choices=sorted(EXTRACTORS), help='record extractor: one xpath search per field, or a single walk over the record (default: %(default)s)')
+    parser.add_argument('--check-extractor', action='store_true', help='run both extractors on every harvard record and report where they disagree')
+    parser.add_argument('--check-citations', action='store_true', help='compare the citations of a few known articles against dash crossref output, if they come up')
+    parser.add_argument('--workers', type=int, default=1, metavar='N', help='number of processes parsing and extracting oai pages in parallel (default: 1)')
+    parser.add_argument('--authority-url', default=SETTINGS['authority_url'], help='getBestMatch endpoint for author lookups (default: %(default)s)')
+    parser.add_argument('--authority-concurrency', type=int, default=SETTINGS['authority_concurrency'], metavar='N', help='concurrent author lookups per process (default: %(default)s)')
+    parser.add_argument('--authority-timeout', type=float, default=SETTINGS['authority_timeout'], metavar='SECONDS', help='timeout per author lookup (default: %(default)s)')
+    parser.add_argument('--authority-retries', type=int, default=SETTINGS['authority_retries'], metavar='N', help='retries per failed author lookup, with exponential backoff (default: %(default)s)')
+    parser.add_argument('--authority-cache', default=SETTINGS['authority_cache'], metavar='PATH', help='sqlite cache of author lookups shared between runs (default: %(default)s)')
+    parser.add_argument('--no-authority-cache', dest='authority_cache', action='store_const', const=None, help='do not read or write the author lookup cache')
+    parser.add_argument('--authority-cache-ttl', type=float, default=SETTINGS['authority_cache_ttl'], metavar='DAYS', help='age after which cached author lookups are fetched again (default: %(default)s)')
+    parser.add_argument('--authority-cache-size', type=int, default=SETTINGS['authority_cache_size'], metavar='N', help='most author lookups kept in the cache, least recently used dropped first (default: %(default)s)')
+    parser.add_argument('--refresh-authorities', action='store_true', help='ignore cached author lookups and fetch them all again (the cache is still updated)')
+    parser.add_argument('--download-concurrency', type=int, default=SETTINGS['download_concurrency'], metavar='N', help='pdf downloads in flight at once (default: %(default)s)')
+    parser.add_argument('--download-rate', type=float, default=SETTINGS['download_rate'], metavar='PER_SECOND', help='average pdf requests per second across all connections (default: %(default)s)')
+    parser.add_argument('--download-burst', type=int, default=SETTINGS['download_burst'], metavar='N', help='pdf requests allowed back to back before the rate applies (default: %(default)s)')
+    parser.add_argument('--article-store', default=SETTINGS['article_store'], metavar='PATH', help='content addressed store of downloaded pdfs shared by all batches, checked before downloading (default: %(default)s)')
+    parser.add_argument('--no-article-store', dest='article_store', action='store_const', const=None, help='do not read or write the article store')
+    parser.add_argument('--article-store-size', type=float, default=SETTINGS['article_store_size'], metavar='GB', help='size the article store is trimmed back to after a run, least recently used files dropped first (default: %(default)s)')
+    parser.add_argument('--link-mode', default=SETTINGS['link_mode'], choices=('copy', 'hardlink', 'reflink', 'auto'), help='how pdfs and license files get into the import packages; links fall back to copying across filesystems, auto tries reflink then hardlink (default: %(default)s)')
+    parser.add_argument('--archive', choices=('tar', 'tar.gz', 'tar.zst', 'zip'), help='write each collection as one archive (import/<collection>.<format>, holding <collection>/<number>/...) instead of a directory tree')
+    parser.add_argument('--dash-index', default=SETTINGS['dash_index'], metavar='PATH', help='dash holdings index used for duplicate detection, built on first use (default: %(default)s)')
+    parser.add_argument('--rebuild-dash-index', action='store_true', help='rebuild the dash holdings index from the bulklib loaders before processing')
+    parser.add_argument('--update-dash-index', action='store_true', help='add the articles loaded by this run to the dash holdings index')
+    parser.add_argument('--incremental', action='store_true', help='skip harvard records whose metadata is unchanged since an earlier batch found them in dash, e.g. when rerunning a month')
+    parser.add_argument('--fingerprints', default=SETTINGS['fingerprints'], metavar='PATH', help='sqlite store of record fingerprints used by --incremental (default: %(default)s)')
+    parser.add_argument('--refresh-reference', action='store_true', help='reload the bulklib reference data (school map, fas departments, dash holdings index) instead of using the cached snapshots')
+    parser.add_argument('--harvest', action='store_true', help='harvest the oai pages from --oai-url into the batch oai directory, processing each page as it arrives')
+    parser.add_argument('--oai-url', metavar='URL', help='oai-pmh ListRecords url for --harvest')
+    parser.add_argument('--resume', action='store_true', help='continue an interrupted run: skip oai pages in the checkpoint journal and keep their output; with --harvest, an unfinished harvest goes on from its last resumptionToken')
+    parser.add_argument('--profile', action='store_true', help='write a cProfile dump of the main process to the report directory')
+    parser.add_argument('--log-level', default=SETTINGS['log_level'], choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'), help='log level (default: %(default)s); DEBUG traces every record')
+    parser.add_argument('-q', '--quiet', dest='log_level', action='store_const', const='WARNING', help='production mode: log warnings and errors only')
     args = parser.parse_args()
-    batch = args.batch
-
-    print("Processing batch: " + batch)
+    batch = args.batch[0]
+    SETTINGS['log_level'] = args.log_level
+    SETTINGS['check_prescreen'] = args.check_prescreen
+    SETTINGS['extractor'] = args.extractor
+    SETTINGS['check_extractor'] = args.check_extractor
+    SETTINGS['check_citations'] = args.check_citations
+    configure_logging()
+    SETTINGS['authority_url'] = args.authority_url
+    SETTINGS['authority_concurrency'] = args.authority_concurrency
+    SETTINGS['authority_timeout'] = args.authority_timeout
+    SETTINGS['authority_retries'] = args.authority_retries
+    SETTINGS['authority_cache'] = args.authority_cache
+    SETTINGS['authority_cache_ttl'] = args.authority_cache_ttl
+    SETTINGS['authority_cache_size'] = args.authority_cache_size
+    SETTINGS['refresh_authorities'] = args.refresh_authorities
+    SETTINGS['download_concurrency'] = args.download_concurrency
+    SETTINGS['download_rate'] = args.download_rate
+    SETTINGS['download_burst'] = args.download_burst
+    SETTINGS['article_store'] = args.article_store
+    SETTINGS['article_store_size'] = args.article_store_size
+    SETTINGS['dash_index'] = args.dash_index
+    SETTINGS['link_mode'] = args.link_mode
+    SETTINGS['archive'] = args.archive
+    SETTINGS['incremental'] = args.incremental
+    SETTINGS['batch'] = batch
+    SETTINGS['fingerprints'] = args.fingerprints
+    SETTINGS['refresh_reference'] = args.refresh_reference
+    SETTINGS['shard'] = args.shard
+    if args.archive and args.resume :
+        parser.error("--archive cannot be combined with --resume: finished archives cannot be reopened")
+    if len(args.batch) > 1 and not args.survey :
+        parser.error("only --survey takes more than one batch")
+    if args.survey and (args.harvest or args.resume) :
+        parser.error("--survey reads already harvested batches and cannot be combined with --harvest or --resume")
+    if args.harvest and not args.oai_url :
+        parser.error("--harvest needs --oai-url")
+    if args.shard and (args.archive or args.harvest or args.update_dash_index or args.survey) :
+        parser.error("--shard cannot be combined with --archive, --harvest, --update-dash-index or --survey: harvest first, and update the dash index with --merge-shards")
+    if args.merge_shards and (args.shard or args.harvest or args.resume or args.survey or args.archive) :
+        parser.error("--merge-shards only combines finished shard runs, into a directory tree")
+    if args.archive == 'tar.zst' and zstandard is None :
+        parser.error("--archive tar.zst needs the zstandard package")
+
+    if args.survey :
+        survey_batches(args.batch, args.workers)
+        return
+    if args.merge_shards :
+        merge_shards(batch, args.merge_shards, args.update_dash_index)
+        return
+
+    started = time.time()
+    profiler = None
+    if args.profile :
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    LOG.info("Processing batch: %s", batch)
 
     base_dir = os.path.join(DATA_DIR, 'batch', batch)
-    print("Base Directory: " + base_dir)
+    LOG.info("Base Directory: %s", base_dir)
 
-    batch_out_dir = os.path.join(base_dir, "import")
-    report_dir =    os.path.join(base_dir, "report")
+    # a shard keeps its output, report and checkpoint apart until --merge-shards.
+    out_dir = shard_dir(base_dir, args.shard[0]) if args.shard else base_dir
+    batch_out_dir = os.path.join(out_dir, "import")
+    report_dir =    os.path.join(out_dir, "report")
 
-    prep_batch_out_dir(batch_out_dir)
+    checkpoint_path = os.path.join(out_dir, "checkpoint.jsonl")
 
     article_number = 0
     report = init_report(batch)
+    metrics = init_metrics()
+    loaded_holdings = []
 
-    fas_depts   = bulklib.load_fas_departments()
-    dash_dois   = bulklib.load_dash_dois()
-    dash_titles = bulklib.load_dash_titles()
-    dash_pmcids = bulklib.load_dash_pmcids()
+    # sorted so article numbering does not depend on directory listing order.
+    oai_dir = os.path.join(base_dir, "oai")
+    oai_files = batch_oai_files(oai_dir)
+    if not args.harvest and not oaiharvest.harvest_complete(oai_dir) :
+        sys.exit("the harvest of {} stopped before its last page: finish it with --harvest --resume --oai-url URL".format(oai_dir))
 
-    for oai_file in glob.glob( os.path.join(base_dir, "oai", '*.xml') ):
-        print("current file is: " + oai_file)
-        report['oai_pages']+=1
-        tree = etree.parse(oai_file)
+    if not os.path.exists(report_dir) :
+        os.makedirs(report_dir)
+    if args.shard and os.path.exists(os.path.join(report_dir, "metrics.json")) :
+        # --merge-shards takes metrics.json to mean that the shard has finished.
+        os.remove(os.path.join(report_dir, "metrics.json"))
+    author_report = open_author_report(report_dir)
+
+    finished_pages = set()
+    if args.resume and os.path.exists(checkpoint_path) :
+        for entry in read_checkpoint(checkpoint_path) :
+            merge_report(report, entry['report'])
+            write_author_report(author_report, entry['authority_report'])
+            loaded_holdings.extend(entry['holdings'])
+            article_number = max([article_number] + [number + 1 for number in entry['article_numbers']])
+            finished_pages.add(entry['page'])
+        oai_files = [oai_file for oai_file in oai_files if os.path.basename(oai_file) not in finished_pages]
+        LOG.info("Resuming batch with %d oai pages left, at article number %d", len(oai_files), article_number)
+        remove_unfinished_articles(batch_out_dir, article_number)
+    else :
+        prep_batch_out_dir(batch_out_dir)
+        if os.path.exists(checkpoint_path) :
+            os.remove(checkpoint_path)
+
+    classifier  = build_school_classifier(fas_departments())
+    dash_index  = load_dash_index(args.rebuild_dash_index)
+
+    if args.harvest :
+        # pages arrive in harvest order, and each one is processed while the next downloads.
+        oai_files = (oai_file for oai_file in oaiharvest.harvest_pages(args.oai_url, oai_dir, args.resume)
+                     if os.path.basename(oai_file) not in finished_pages)
+
+    pool = None
+    if args.workers > 1 :
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(SETTINGS,))
+        # imap hands back pages in submission order, which keeps article numbering deterministic.
+        pages = pool.imap(functools.partial(process_page, classifier=classifier), oai_files)
+    else :
+        pages = (process_page(oai_file, classifier) for oai_file in oai_files)
+
+    for page in pages:
+        article_numbers, holdings, fingerprints = load_page_articles(batch, batch_out_dir, page, dash_index, article_number)
+        article_number += len(article_numbers)
+        merge_report(report, page['report'])
+        merge_metrics(metrics, page['metrics'])
+        write_author_report(author_report, page['authority_report'])
+        loaded_holdings.extend(holdings)
+        write_checkpoint(checkpoint_path, page, article_numbers, holdings)
+        if fingerprints :
+            write_fingerprints(batch, fingerprints)
+
+    if pool is not None :
+        pool.close()
+        pool.join()
+    close_archives(batch_out_dir)
+
+    if SETTINGS['authority_cache'] :
+        trim_authority_cache()
+    if SETTINGS['article_store'] :
+        trim_article_store()
+    if args.update_dash_index and loaded_holdings :
+        dashindex.close_index(dash_index)
+        LOG.info("Adding %d loaded articles to dash holdings index", report['articles_loaded'])
+        dashindex.update_index(SETTINGS['dash_index'], loaded_holdings)
 
-        # Get default namespaces out of the document - we've had issues with the article NS switching from HTTP to HTTPS
-        global OAI_NS, ARTICLE_NS
+    print_report(report)
+    close_author_report(author_report)
+    write_metrics(report_dir, metrics, report, time.time() - started, args.workers)
+    if profiler is not None :
+        profiler.disable()
+        profiler.dump_stats(os.path.join(report_dir, "pmc2dash.prof"))
+        LOG.info("Wrote profile: %s", os.path.join(report_dir, "pmc2dash.prof"))
+
+
+def parse_shard(text):
+    '''I/N on the command line to (I, N).'''
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be I/N, e.g. 0/4")
+    if not 0 <= index < count :
+        raise argparse.ArgumentTypeError("shard index must be from 0 to N-1")
+    return index, count
+
+
+def shard_of(pmcid, count):
+    # a fixed hash rather than hash(), which python salts per process.
+    return int.from_bytes(hashlib.blake2b(pmcid.encode('utf-8'), digest_size=8).digest(), 'little') % count
+
+
+def in_shard(metadata_node):
+    '''Whether a record belongs to this run's shard, going by the pmc id in its oai header identifier.
+
+    The header is read rather than the article, so that non-harvard records cost no search.
+    A record without an identifier goes to shard 0, so that no shard loses it.'''
+    index, count = SETTINGS['shard']
+    identifier = record_identifier(metadata_node)
+    if identifier is None :
+        LOG.warning("record without an oai identifier, left to shard 0")
+        return index == 0
+    # oai:pubmedcentral.nih.gov:1234567
+    return shard_of(identifier.rsplit(':', 1)[-1], count) == index
+
+
+def record_identifier(metadata_node):
+    header = metadata_node.getprevious()
+    if header is None :
+        return None
+    identifier_tag = '{{{}}}identifier'.format(OAI_NS)
+    for node in header :
+        if node.tag == identifier_tag :
+            return (node.text or '').strip() or None
+    return None
 
-        if not OAI_NS:
-            OAI_NS = dict(tree.xpath('/*/namespace::*')).get(None, 'http://www.openarchives.org/OAI/2.0/')
-        if not ARTICLE_NS:
-            ARTICLE_NS = dict(tree.xpath('//*[local-name(.) = "article"]/namespace::*')).get(None, 'https://jats.nlm.nih.gov/ns/archiving/1.0/')
 
-        for article_node in tree.findall('.//{{{}}}metadata'.format(OAI_NS)):
-            report['articles_total']+=1
-            if is_harvard_article_node(etree,article_node) :
-                report['articles_harvard'] += 1
-                article = extract_article(article_node)
-                assign_article_schools(article,fas_depts)
-                attach_authorities(article)
-                for author in article['authors'] :
-                    if author['has_harvard_affstring'] :
-                        update_harvard_author_counts(report,author)
-                update_harvard_article_counts(report,article)
-                in_dash = already_in_dash(article,dash_dois,dash_titles,dash_pmcids)
-                if not in_dash :
-                    target_collection_dir = get_target_collection_dir(article)
-                    print("REINOS: target_collection_dir: " + target_collection_dir)
-                    if target_collection_dir == '' :
-                        report['articles_error_no_valid_school'] += 1
-                        print("REINOS: no valid LDAP or PMC school!")
-                        print("REINOS: LDAP schools:"+str(article['ldap_schools']))
-                        print("REINOS: PMC schools:"+str(article['pmc_schools']))
-                    else :
-                        download_files(article,batch)
-                        if len(article['files']) > 0 :
-                            # create dspace import packages for stuff that we were able to find harvard authority codes for.
-                            # and has files and is not already in dash.
-                            article['license'] = 'LAA' # as of Feb 2014 per Colin and Becky, license always == LAA
-                            write_output(batch,batch_out_dir,article, article_number)
-                            article_number += 1
-                            report['articles_loaded']+= 1
-                        else :
-                            report['articles_error_no_files']+= 1
-                else :
-                    report['articles_already_in_dash']+= 1
+def shard_dir(base_dir, index):
+    return os.path.join(base_dir, "shards", str(index))
 
-    if not os.path.exists(report_dir) :
-        os.mkdir(report_dir)
-    print_report(report)
-    write_author_report(report_dir)
 
-def write_author_report(report_dir):
-    pmcid2dashid = tsv.read_map(os.path.join(OSCROOT, 'proj/ingest/data/tsv/pmcid2dashid.tsv'))
-    jsondata={}
-    jsondata['data']=[]
-    jsondata['timestamp']='2014-02-20 19:36:32'
-    for AR in AUTHORITY_REPORT :
-        pa = AR['pmc_author']
-        affstring = "|".join(aff['text'] for aff in pa.get('affs', []))
+def merge_shards(batch, shard_count, update_dash_index):
+    '''--merge-shards: combine the shard runs of a batch into the batch's own import, report and author report.
 
-        la={'label':'NO MATCH', 'confidence' : 0.0}
+    Articles are renumbered shard by shard, in each shard's order. Their packages are hardlinked rather than moved,
+    so the shards stay whole and the merge can be run again.
+    Every shard reads every oai page, so oai_pages is the count of one shard rather than the sum.'''
+    base_dir = os.path.join(DATA_DIR, 'batch', batch)
+    shard_dirs = [shard_dir(base_dir, index) for index in range(shard_count)]
+    shards_dir = os.path.join(base_dir, "shards")
+    for name in (os.listdir(shards_dir) if os.path.exists(shards_dir) else []) :
+        if not (name.isdigit() and int(name) < shard_count) :
+            sys.exit("{} is not part of a {} shard split: remove it, or merge with its shard count".format(
+                os.path.join(shards_dir, name), shard_count))
+    for index, path in enumerate(shard_dirs) :
+        # metrics.json is the last thing a run writes.
+        metrics_path = os.path.join(path, "report", "metrics.json")
+        if not os.path.exists(metrics_path) :
+            sys.exit("shard {} has not finished: no {}".format(path, metrics_path))
+        with open(metrics_path) as f:
+            shard = json.load(f).get('shard')
+        if shard != [index, shard_count] :
+            sys.exit("{} is from a run of shard {}, not {}/{}".format(
+                metrics_path, '/'.join(str(part) for part in shard) if shard else 'none', index, shard_count))
 
+    batch_out_dir = os.path.join(base_dir, "import")
+    report_dir =    os.path.join(base_dir, "report")
+    prep_batch_out_dir(batch_out_dir)
+    if not os.path.exists(report_dir) :
+        os.mkdir(report_dir)
+    author_report = open_author_report(report_dir)
+    report = init_report(batch)
+    metrics = init_metrics()
+    oai_pages = 0
+    wall_seconds = 0
+    workers = 0
+    article_number = 0
+    loaded_holdings = []
+    for path in shard_dirs :
+        LOG.info("Merging shard: %s", path)
+        with open(os.path.join(path, "report", "metrics.json")) as f:
+            shard_metrics = json.load(f)
+        merge_report(report, shard_metrics['counters'])
+        merge_metrics(metrics, {'seconds': {stage: shard_metrics['stages'][stage]['seconds'] for stage in STAGES},
+                                'calls': {stage: shard_metrics['stages'][stage]['calls'] for stage in STAGES}})
+        oai_pages = max(oai_pages, shard_metrics['counters']['oai_pages'])
+        # shards run side by side, on hosts of their own.
+        wall_seconds = max(wall_seconds, shard_metrics['wall_seconds'])
+        workers += shard_metrics['workers']
+        article_number = link_shard_articles(os.path.join(path, "import"), batch_out_dir, article_number)
+        with open(os.path.join(path, "report", "author-report.json")) as f:
+            write_author_rows(author_report, json.load(f)['data'])
+        if update_dash_index and os.path.exists(os.path.join(path, "checkpoint.jsonl")) :
+            for entry in read_checkpoint(os.path.join(path, "checkpoint.jsonl")) :
+                loaded_holdings.extend(entry['holdings'])
+    report['oai_pages'] = oai_pages
+
+    if loaded_holdings :
+        LOG.info("Adding %d loaded articles to dash holdings index", report['articles_loaded'])
+        dashindex.update_index(SETTINGS['dash_index'], loaded_holdings)
+    print_report(report)
+    close_author_report(author_report)
+    write_metrics(report_dir, metrics, report, wall_seconds, workers)
+
+
+def link_shard_articles(shard_out_dir, batch_out_dir, article_number):
+    '''Link a shard's article packages into batch_out_dir, renumbered in order from article_number. Returns the next number.'''
+    articles = []
+    for collection in os.listdir(shard_out_dir) :
+        for number in os.listdir(os.path.join(shard_out_dir, collection)) :
+            articles.append((int(number), collection))
+    for number, collection in sorted(articles) :
+        collection_out_dir = os.path.join(batch_out_dir, collection)
+        if not os.path.exists(collection_out_dir) :
+            os.mkdir(collection_out_dir)
+        shutil.copytree(os.path.join(shard_out_dir, collection, str(number)), os.path.join(collection_out_dir, str(article_number)),
+                        copy_function=link_or_copy)
+        article_number += 1
+    return article_number
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # most likely source and target are on different filesystems.
+        shutil.copyfile(src, dst)
+
+
+def batch_oai_files(oai_dir):
+    return sorted(glob.glob(os.path.join(oai_dir, '*.xml')) + glob.glob(os.path.join(oai_dir, '*.xml.gz')))
+
+
+def survey_batches(batches, workers):
+    '''--survey: tally harvard records by pmc school and fas department over harvested batches.
+
+    Each batch gets report/survey.json; the totals over all batches are printed.'''
+    started = time.time()
+    classifier = build_school_classifier(fas_departments())
+    pool = None
+    if workers > 1 :
+        pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(SETTINGS,))
+    total = init_survey(None)
+    for batch in batches :
+        base_dir = os.path.join(DATA_DIR, 'batch', batch)
+        LOG.info("Surveying batch: %s", batch)
+        if not oaiharvest.harvest_complete(os.path.join(base_dir, "oai")) :
+            LOG.warning("the harvest of %s stopped before its last page: surveying the pages it got", batch)
+        oai_files = batch_oai_files(os.path.join(base_dir, "oai"))
+        if pool is not None :
+            pages = pool.imap(functools.partial(survey_page, classifier=classifier), oai_files)
+        else :
+            pages = (survey_page(oai_file, classifier) for oai_file in oai_files)
+        survey = init_survey(batch)
+        for page in pages :
+            merge_survey(survey, page)
+        merge_survey(total, survey)
+        report_dir = os.path.join(base_dir, "report")
+        if not os.path.exists(report_dir) :
+            os.mkdir(report_dir)
+        with open(os.path.join(report_dir, "survey.json"), "w") as f:
+            json.dump(survey, f, indent=2, sort_keys=True)
+    if pool is not None :
+        pool.close()
+        pool.join()
+
+    total['report']['batch'] = " ".join(batches)
+    print_report(total['report'])
+    for tally in ('schools', 'departments') :
+        for key, count in sorted(total[tally].items(), key=lambda item: (-item[1], item[0])) :
+            print("{} {}: {}".format(tally, key, count))
+    LOG.info("Surveyed %d batches in %.1fs", len(batches), time.time() - started)
+
+
+def init_survey(batch):
+    report = {key: 0 for key in ('oai_pages', 'articles_total', 'articles_harvard', 'articles_no_school',
+                                 'prescreen_mismatches', 'prescreen_false_positives')}
+    report['batch'] = batch
+    return {'report': report, 'schools': {}, 'departments': {}}
+
+
+def merge_survey(survey, page_survey):
+    merge_report(survey['report'], page_survey['report'])
+    for tally in ('schools', 'departments') :
+        for key, count in page_survey[tally].items() :
+            survey[tally][key] = survey[tally].get(key, 0) + count
+
+
+def survey_page(oai_file, classifier):
+    '''Prescreen one oai page and count the schools and departments of its harvard articles.'''
+    LOG.info("current file is: %s", oai_file)
+    survey = init_survey(None)
+    report = survey['report']
+    report['oai_pages'] += 1
+    for article_node, harvard in iter_page_records(oai_file):
+        report['articles_total'] += 1
+        if SETTINGS['check_prescreen'] :
+            check_prescreen(report,article_node,harvard)
+        if not (harvard and is_harvard_article_node(etree,article_node)) :
+            continue
+        report['articles_harvard'] += 1
+        article = survey_article(article_node)
+        assign_article_schools(article,classifier)
+        # '' is a fas affiliation without a department, which only ldap could place.
+        schools = article['pmc_schools'] - {''}
+        if not schools :
+            report['articles_no_school'] += 1
+        for school in schools :
+            survey['schools'][school] = survey['schools'].get(school, 0) + 1
+        for dept in article['pmc_depts'] :
+            survey['departments'][dept] = survey['departments'].get(dept, 0) + 1
+    return survey
+
+
+def survey_article(article_node):
+    '''Just the authors and affs that assign_article_schools works from.'''
+    affs = build_affs(extract_affs(article_node))
+    return {'pmcid':        extract_pmcid(article_node),
+            'authors':      build_authors(extract_authors(article_node),affs),
+            'ldap_schools': set(),
+            'pmc_schools':  set(),
+            'pmc_depts':    set()}
+
+
+def load_page_articles(batch, batch_out_dir, page, dash_index, article_number):
+    '''Check, download and write out the harvard articles of a processed page, numbering them from article_number.
+
+    Counts go into the page report. Returns the article numbers written, the (kind, value) dash holdings they add
+    and the (pmcid, fingerprint) pairs of the articles found in dash, for --incremental. Loaded articles are
+    not fingerprinted: they only count as settled once a later run finds them in dash, after a successful import.'''
+    report = page['report']
+    to_load = []
+    fingerprints = []
+    for article in page['articles']:
+        in_dash = already_in_dash(article,dash_index)
+        if in_dash and 'fingerprint' in article :
+            fingerprints.append((article['pmcid'], article['fingerprint']))
+        if not in_dash :
+            target_collection_dir = get_target_collection_dir(article)
+            OUTPUT_LOG.debug("target_collection_dir: %s", target_collection_dir)
+            if target_collection_dir == '' :
+                report['articles_error_no_valid_school'] += 1
+                OUTPUT_LOG.info("no valid LDAP or PMC school for PMC%s (LDAP schools: %s, PMC schools: %s)",
+                                article['pmcid'], article['ldap_schools'], article['pmc_schools'])
+            else :
+                to_load.append(article)
+        else :
+            report['articles_already_in_dash']+= 1
+
+    article_numbers = []
+    holdings = []
+    with stage_timer(page['metrics'], 'download') :
+        download_page_files(to_load,batch)
+    for article in to_load:
+        if len(article['files']) > 0 :
+            # create dspace import packages for stuff that we were able to find harvard authority codes for.
+            # and has files and is not already in dash.
+            article['license'] = 'LAA' # as of Feb 2014 per Colin and Becky, license always == LAA
+            with stage_timer(page['metrics'], 'output_write') :
+                report['output_bytes_saved'] += write_output(batch,batch_out_dir,article, article_number)
+            article_numbers.append(article_number)
+            article_number += 1
+            report['articles_loaded']+= 1
+            holdings.extend((kind, article.get(kind)) for kind in dashindex.KINDS)
+        else :
+            report['articles_error_no_files']+= 1
+    return article_numbers, holdings, fingerprints
+
+
+def write_checkpoint(checkpoint_path, page, article_numbers, holdings):
+    '''Journal a finished page so that --resume can skip it.'''
+    entry = {'page': os.path.basename(page['oai_file']),
+             'article_numbers': article_numbers,
+             'report': page['report'],
+             'authority_report': page['authority_report'],
+             'holdings': holdings}
+    with open(checkpoint_path, "a") as f:
+        f.write(json.dumps(entry, default=sorted) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_checkpoint(checkpoint_path):
+    entries = []
+    with open(checkpoint_path) as f:
+        for line in f :
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # a line cut short by the crash we are resuming from.
+                LOG.warning("Ignoring incomplete checkpoint entry")
+    return entries
+
+
+def remove_unfinished_articles(batch_out_dir, article_number):
+    '''Remove article directories numbered from article_number on, left by a page that never finished.'''
+    for collection in os.listdir(batch_out_dir) :
+        collection_out_dir = os.path.join(batch_out_dir, collection)
+        for number in os.listdir(collection_out_dir) :
+            if int(number) >= article_number :
+                LOG.info("Removing unfinished article: %s", os.path.join(collection_out_dir, number))
+                shutil.rmtree(os.path.join(collection_out_dir, number))
+        if not os.listdir(collection_out_dir) :
+            os.rmdir(collection_out_dir)
+
+
+def init_worker(settings):
+    '''Pool initializer: carry the run settings over to worker processes.'''
+    SETTINGS.update(settings)
+    configure_logging()
+
+
+def configure_logging():
+    logging.basicConfig(stream=sys.stdout, level=SETTINGS['log_level'],
+                        format='%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s', force=True)
+
+
+def process_page(oai_file, classifier):
+    '''Parse one oai page and extract its harvard articles, with authorities attached.
+
+    Returns the page's report counters, articles and authority report entries so that
+    pages can be handled in worker processes and merged back in page order.'''
+    LOG.info("current file is: %s", oai_file)
+    report = init_report(None)
+    metrics = init_metrics()
+    report['oai_pages']+=1
+    articles = []
+    authority_report_start = len(AUTHORITY_REPORT)
+    # the byte prescreen runs as the page is read, so its time is part of page_parse.
+    for article_node, harvard in timed_iter(metrics, 'page_parse', iter_page_records(oai_file)):
+        if SETTINGS['shard'] and not in_shard(article_node) :
+            continue
+        report['articles_total']+=1
+        with stage_timer(metrics, 'prescreen') :
+            if SETTINGS['check_prescreen'] :
+                check_prescreen(report,article_node,harvard)
+            harvard = harvard and is_harvard_article_node(etree,article_node)
+        if harvard :
+            report['articles_harvard'] += 1
+            if SETTINGS['incremental'] :
+                fingerprint = hashlib.sha1(etree.tostring(article_node)).hexdigest()
+                if read_fingerprint(extract_pmcid(article_node), SETTINGS['batch']) == fingerprint :
+                    report['articles_unchanged'] += 1
+                    continue
+            with stage_timer(metrics, 'extraction') :
+                article = extract_article(article_node)
+            if SETTINGS['incremental'] :
+                article['fingerprint'] = fingerprint
+            if SETTINGS['check_extractor'] :
+                check_extractor(report,article_node,article)
+            if SETTINGS['check_citations'] :
+                check_citation(report,article)
+            with stage_timer(metrics, 'school_assignment') :
+                assign_article_schools(article,classifier)
+            articles.append(article)
+    with stage_timer(metrics, 'authority_lookup') :
+        attach_page_authorities(articles, report)
+    for article in articles :
+        for author in article['authors'] :
+            if author['has_harvard_affstring'] :
+                update_harvard_author_counts(report,author)
+        update_harvard_article_counts(report,article)
+    # hand this page's entries back to the caller rather than leaving them in the (possibly worker) global.
+    authority_report = AUTHORITY_REPORT[authority_report_start:]
+    del AUTHORITY_REPORT[authority_report_start:]
+    return {'oai_file': oai_file, 'report': report, 'metrics': metrics, 'articles': articles, 'authority_report': authority_report}
+
+
+def iter_page_records(oai_file):
+    '''Stream (metadata node, prescreen) for the records of an oai page; harvested pages may be gzipped.
+
+    The page goes to the parser in pieces that end with a </record>, and the raw bytes of each piece are
+    scanned for harvard on the way: prescreen is False only if no byte of the record mentions harvard.
+    Pieces that do not line up with records (prefixed oai tags, say) only make the prescreen pass more.
+    Each record is cleared once the caller is done with it, so memory stays flat however big the page is.'''
+    # Get default namespaces out of the document - we've had issues with the article NS switching from HTTP to HTTPS
+    global OAI_NS, ARTICLE_NS
+
+    metadata_tag = None
+    record_tag = None
+    parser = etree.XMLPullParser(events=('start', 'end'))
+    pending = bytearray()
+    harvard = False
+    with (gzip.open(oai_file, 'rb') if oai_file.endswith('.gz') else open(oai_file, 'rb')) as f :
+        while True :
+            block = f.read(PAGE_READ_SIZE)
+            pending += block
+            start = 0
+            while start < len(pending) :
+                end = pending.find(RECORD_END, start)
+                if end >= 0 :
+                    end += len(RECORD_END)
+                elif block :
+                    break
+                else :
+                    # whatever follows the last record, at the end of the page.
+                    end = len(pending)
+                piece = bytes(pending[start:end])
+                harvard = harvard or prescreen_harvard(piece)
+                parser.feed(piece)
+                start = end
+                last_event = None
+                for event, node in parser.read_events():
+                    last_event = (event, node.tag)
+                    if event == 'start':
+                        if not OAI_NS:
+                            OAI_NS = node.nsmap.get(None, 'http://www.openarchives.org/OAI/2.0/')
+                        if not ARTICLE_NS and etree.QName(node).localname == 'article':
+                            ARTICLE_NS = node.nsmap.get(None, 'https://jats.nlm.nih.gov/ns/archiving/1.0/')
+                        continue
+                    if metadata_tag is None:
+                        metadata_tag = '{{{}}}metadata'.format(OAI_NS)
+                        record_tag = '{{{}}}record'.format(OAI_NS)
+                    if node.tag == metadata_tag:
+                        yield node, harvard
+                    elif node.tag == record_tag:
+                        # drop the finished record and anything before it still hanging off the tree.
+                        node.clear()
+                        while node.getprevious() is not None:
+                            del node.getparent()[0]
+                # the piece ended with its record: nothing of the next record has been scanned yet.
+                if last_event == ('end', record_tag) :
+                    harvard = False
+            del pending[:start]
+            if not block :
+                break
+    parser.close()
+
+
+def open_author_report(report_dir):
+    '''Start author-report.json, which rows are streamed into as pages finish.'''
+    path = os.path.join(report_dir, "author-report.json")
+    f = open(path + ".part", "w", encoding='utf-8')
+    # the same document json.dumps({'data': rows, 'timestamp': ...}) used to write in one go.
+    f.write('{"data": [')
+    return {'path': path, 'file': f, 'rows': 0, 'dashids': pmcid2dashid_db()}
+
+
+def write_author_report(author_report, entries):
+    rows = []
+    for AR in entries :
         dashid=""
-        if AR['pmcid'] in pmcid2dashid :
-            dashid = '<a href="{0}">{0}</a>'.format(pmcid2dashid[AR['pmcid']])
-        if 'best_match_author' in AR :
-            la = AR['best_match_author']
+        row = author_report['dashids'].execute('SELECT dashid FROM dashids WHERE pmcid = ?', (AR['pmcid'],)).fetchone()
+        if row :
+            dashid = '<a href="{0}">{0}</a>'.format(row[0])
         jsonrow = ('<a href="http://www.ncbi.nlm.nih.gov/pmc/articles/PMC{0}">{0}</a>'.format(AR['pmcid']),
                    dashid,
                    AR['title'],
-                   pa['first'],
-                   pa['last'],
-                   affstring,
-                   '<a href="{}">{}</a>'.format(AR['json_url'], len(AR['ldap_authors'])),
-                   la['label'],
-                   la['confidence'],)
-        jsondata['data'].append(jsonrow)
-    with open(report_dir+"/author-report.json", "wb") as f:
-        f.write(bytes(json.dumps(jsondata), 'UTF-8'))
+                   AR['first'],
+                   AR['last'],
+                   AR['affstring'],
+                   '<a href="{}">{}</a>'.format(AR['json_url'], AR['match_count']),
+                   AR['label'],
+                   AR['confidence'],)
+        rows.append(jsonrow)
+    write_author_rows(author_report, rows)
+
+
+def write_author_rows(author_report, rows):
+    '''Append finished rows, e.g. those of a shard's author report.'''
+    f = author_report['file']
+    for jsonrow in rows :
+        if author_report['rows'] :
+            f.write(", ")
+        f.write(json.dumps(jsonrow))
+        author_report['rows'] += 1
+
+
+def close_author_report(author_report):
+    author_report['file'].write('], "timestamp": "2014-02-20 19:36:32"}')
+    author_report['file'].close()
+    author_report['dashids'].close()
+    os.replace(author_report['path'] + ".part", author_report['path'])
+
+
+def pmcid2dashid_db():
+    '''sqlite index of pmcid2dashid.tsv, rebuilt whenever the tsv changes.'''
+    tsv_path = os.path.join(OSCROOT, 'proj/ingest/data/tsv/pmcid2dashid.tsv')
+    index_path = SETTINGS['pmcid2dashid_index']
+    index_dir = os.path.dirname(index_path)
+    if index_dir and not os.path.exists(index_dir) :
+        os.makedirs(index_dir)
+    tsv_stat = os.stat(tsv_path)
+    signature = "{} {}".format(tsv_stat.st_mtime_ns, tsv_stat.st_size)
+    db = sqlite3.connect(index_path, timeout=60)
+    db.execute('CREATE TABLE IF NOT EXISTS dashids (pmcid TEXT PRIMARY KEY, dashid TEXT)')
+    db.execute('CREATE TABLE IF NOT EXISTS source (signature TEXT)')
+    row = db.execute('SELECT signature FROM source').fetchone()
+    if row is None or row[0] != signature :
+        LOG.info("Indexing %s", tsv_path)
+        with db :
+            db.execute('DELETE FROM dashids')
+            db.executemany('INSERT OR REPLACE INTO dashids (pmcid, dashid) VALUES (?, ?)', tsv.read_map(tsv_path).items())
+            db.execute('DELETE FROM source')
+            db.execute('INSERT INTO source (signature) VALUES (?)', (signature,))
+    return db
+
 
 def update_harvard_article_counts(report,article):
     if article['found_all_harvard_auths']:
@@ -162,35 +882,96 @@ def init_report(batch):
         'articles_already_in_dash', 'articles_loaded', 'found_all_harvard_auths', 'found_any_harvard_auths', 'found_no_harvard_auths',
         'harvard_authors_single_match_count', 'harvard_authors_matched_count', 'harvard_authors_multiple_matches_count', 'harvard_authors_no_matches_count',
         'harvard_authors_count', # aff string says harvard.
+        'prescreen_mismatches', 'prescreen_false_positives', 'extractor_mismatches', 'citation_mismatches',
+        'authority_cache_hits', 'authority_cache_misses',
+        'output_bytes_saved', # pdf and license bytes linked rather than copied into the import tree.
+        'articles_unchanged', # --incremental: harvard records skipped as found in dash by an earlier batch.
     )}
     report['batch'] = batch
     return report
 
+def merge_report(report,page_report):
+    for key, value in page_report.items():
+        if key != 'batch' :
+            report[key] += value
+
+def init_metrics():
+    '''Per stage wall clock seconds and call counts.'''
+    return {'seconds': {stage: 0.0 for stage in STAGES}, 'calls': {stage: 0 for stage in STAGES}}
+
+@contextlib.contextmanager
+def stage_timer(metrics, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics['seconds'][stage] += time.perf_counter() - start
+        metrics['calls'][stage] += 1
+
+def timed_iter(metrics, stage, iterable):
+    '''Yield from iterable, charging the time spent producing each item to stage.'''
+    iterator = iter(iterable)
+    while True:
+        with stage_timer(metrics, stage) :
+            item = next(iterator, StopIteration)
+        if item is StopIteration :
+            return
+        yield item
+
+def merge_metrics(metrics, page_metrics):
+    for stage in STAGES :
+        metrics['seconds'][stage] += page_metrics['seconds'][stage]
+        metrics['calls'][stage] += page_metrics['calls'][stage]
+
+def write_metrics(report_dir, metrics, report, wall_seconds, workers):
+    '''Write per stage timings and the report counters as metrics.json next to author-report.json.
+
+    With --workers, the worker stages add up time across processes, so together they can exceed wall_seconds.
+    A --shard run records its [I, N], for --merge-shards to check.'''
+    jsondata = {'batch': report['batch'],
+                'shard': SETTINGS['shard'],
+                'wall_seconds': round(wall_seconds, 3),
+                'workers': workers,
+                'stages': {stage: {'seconds': round(metrics['seconds'][stage], 3), 'calls': metrics['calls'][stage]} for stage in STAGES},
+                'counters': {key: value for key, value in report.items() if key != 'batch'}}
+    with open(os.path.join(report_dir, "metrics.json"), "w") as f:
+        json.dump(jsondata, f, indent=2, sort_keys=True)
+
 def print_report(report):
     for key in sorted(report.keys()):
         print(key+": " + str(report[key]))
 
 
+def article_xpath(tag,key=None,value=None,first=False):
+    '''Compiled .//article:tag lookup for the current ARTICLE_NS, optionally with an attribute predicate.'''
+    cache_key = (ARTICLE_NS,tag,key,value,first)
+    xpath = ARTICLE_XPATHS.get(cache_key)
+    if xpath is None :
+        path = './/article:{}'.format(tag)
+        if key is not None :
+            path += '[@{}="{}"]'.format(key,value)
+        if first :
+            path = '({})[1]'.format(path)
+        xpath = ARTICLE_XPATHS[cache_key] = etree.XPath(path, namespaces={'article': ARTICLE_NS})
+    return xpath
+
+
 def findall(node,tag):
-    return node.findall('.//article:{}'.format(tag), namespaces={'article': ARTICLE_NS})
+    return article_xpath(tag)(node)
 
 
 def find(node,tag):
-    return node.find('.//article:{}'.format(tag), namespaces={'article': ARTICLE_NS})
+    found = article_xpath(tag,first=True)(node)
+    return found[0] if found else None
 
 
 def find_attrib(node,tag,key,value) :
-    for subnode in findall(node,tag) :
-        if key in subnode.attrib and subnode.attrib[key] == value :
-            return subnode
+    found = article_xpath(tag,key,value,first=True)(node)
+    return found[0] if found else None
 
 
 def findall_attrib(node,tag,key,value) :
-    foundnodes = []
-    for subnode in findall(node,tag) :
-        if key in subnode.attrib and subnode.attrib[key] == value :
-            foundnodes.append(subnode)
-    return foundnodes
+    return article_xpath(tag,key,value)(node)
 
 
 def is_harvard_article_node(etree,article_node):
@@ -199,86 +980,147 @@ def is_harvard_article_node(etree,article_node):
     for aff_node in findall(article_node,'aff'):
         affString = str(etree.tostring(aff_node, encoding="utf-8"))
 
-        if re.search("harvard",affString.lower().replace("harvard\.edu","").replace("harvard ave","")):
-            print(affString)
+        if "harvard" in affString.lower().replace("harvard\.edu","").replace("harvard ave",""):
+            EXTRACT_LOG.debug("harvard aff: %s", affString)
             return True
     return False
 
 
+def prescreen_harvard(record_bytes):
+    '''Cheap byte scan of a record, as read from the oai page, for the harvard token.
+
+    Only strips what is_harvard_article_node strips, so a record it would accept always passes.'''
+    return HARVARD_TOKEN in record_bytes.lower().replace(HARVARD_AVE_TOKEN, b'')
+
+
+def check_prescreen(report,article_node,harvard):
+    # the prescreen may let extra records through (harvard outside an aff), but must never drop one.
+    if is_harvard_article_node(etree,article_node) :
+        if not harvard :
+            report['prescreen_mismatches'] += 1
+            EXTRACT_LOG.warning("prescreen mismatch: rejected harvard article %s", extract_pmcid(article_node))
+    elif harvard :
+        report['prescreen_false_positives'] += 1
+
+
+class ArticleRecord(object):
+    '''Fields of one jats record as extracted, before the pipeline's bookkeeping is added.
+
+    Optional text fields are None when the element (or its text) is missing.'''
+    __slots__ = ('title', 'journal', 'type', 'pmcid', 'issn', 'subjects', 'abstract', 'affs', 'authors',
+                 'doi', 'publisher', 'volume', 'issue', 'fpage', 'lpage', 'elocation_id', 'date')
+
+    def __init__(self, **fields):
+        for key in self.__slots__ :
+            setattr(self, key, fields.get(key))
+
+
+class AffRecord(object):
+    __slots__ = ('id', 'sup', 'text')
+
+    def __init__(self, id, sup, text):
+        self.id = id
+        self.sup = sup
+        self.text = text
+
+
+class AuthorRecord(object):
+    __slots__ = ('last', 'first', 'aff_ids')
+
+    def __init__(self, last, first, aff_ids):
+        self.last = last
+        self.first = first
+        self.aff_ids = aff_ids
+
+
+def node_text(node):
+    return node.text if node is not None else None
+
+
 def extract_affs(article_node):
-    affs = []
-    for aff_node in findall(article_node,'aff') :
-        aff = {}
-        aff['id']= aff_node.attrib.get('id',None)
-        settext(aff,'sup',find(aff_node,'sup'))
-        aff['text']= catnode(aff_node)
-        affs.append(aff)
-    return affs
+    return [AffRecord(aff_node.attrib.get('id',None), node_text(find(aff_node,'sup')), catnode(aff_node))
+            for aff_node in findall(article_node,'aff')]
 
 
 def extract_aff_ids(author_node) :
     '''Extract aff_ids from xrefs within author node.'''
-    return [xref_node.attrib['rid'] for xref_node in findall_attrib(author_node,"xref","ref-type","aff")]
+    return [xref_node.attrib['rid'] for xref_node in findall_attrib(author_node,"xref","ref-type","aff") if 'rid' in xref_node.attrib]
 
 
-def extract_authors(article_node,affs):
-    authors = []
+def extract_authors(article_node):
     #contrib contrib-type="author"
     # we filter out editors here.
-    for author_node in findall_attrib(article_node,'contrib','contrib-type','author') :
+    return [AuthorRecord(node_text(find(author_node,'surname')), node_text(find(author_node,'given-names')), extract_aff_ids(author_node))
+            for author_node in findall_attrib(article_node,'contrib','contrib-type','author')]
+
+
+def build_affs(aff_records):
+    affs = []
+    for record in aff_records :
+        aff = {'id': record.id}
+        if record.sup is not None :
+            aff['sup'] = record.sup
+        aff['text'] = record.text
+        affs.append(aff)
+    return affs
+
+
+def build_authors(author_records,affs):
+    '''Turn author records into author dicts linked to their affs, dropping duplicate names.'''
+    authors = []
+    names = {}
+    # aff positions by id, so linking an author costs its own aff ids rather than all the article's affs.
+    aff_positions = {}
+    for position, aff in enumerate(affs) :
+        aff_positions.setdefault(aff['id'], []).append(position)
+    for record in author_records :
         author = {'has_harvard_affstring': False,
                   'authority': UNAFFILIATED,
                   'match_count': 0,
                   'ldap_schools': set()}
 
-        settext(author, 'last',  find(author_node,'surname'))
-        settext(author, 'first', find(author_node,'given-names'))
+        if record.last is not None :
+            author['last'] = record.last
+        if record.first is not None :
+            author['first'] = record.first
 
         if len(affs) == 1:
             # there's just one possible aff.
             author['affs'] = affs
         else:
             # there are multiple possible affs.
-            author['affs']=[]
-            author['aff_ids']=extract_aff_ids(author_node)
-            for aff in affs :
-                for aff_id in author['aff_ids'] :
-                    if aff_id == aff['id'] :
-                        author['affs'].append(aff)
+            author['aff_ids']=record.aff_ids
+            # affs in document order, repeated once per matching aff id.
+            positions = [position for aff_id in author['aff_ids'] for position in aff_positions.get(aff_id, ())]
+            author['affs']=[affs[position] for position in sorted(positions)]
         if len(author['affs']) == 0:
             # I think that's OK. As long as one of the article authors has an affiation. - Ben
-            print("UNABLE TO EXTRACT AFF INFO FROM AUTHOR: {}".format(author))
-            print("AFFS: {}".format(affs))
+            EXTRACT_LOG.debug("unable to extract aff info from author: %s (affs: %s)", author, affs)
 
         if 'last' in author :
-            newAuthor = True
-            for a in authors :
-                if a['last'] == author['last'] and a.get('first', False) == author.get('first', False) :
-                    print("REINOS: WOAH: AUTHOR DUPLICATION ******************************************")
-                    pprint(a)
-                    pprint(author)
-                    newAuthor=False
-                    break
-            if newAuthor :
+            name = (author['last'], author.get('first', False))
+            if name in names :
+                if EXTRACT_LOG.isEnabledFor(logging.DEBUG) :
+                    EXTRACT_LOG.debug("author duplication:\n%s\n%s", pformat(names[name]), pformat(author))
+            else :
+                names[name] = author
                 authors.append(author)
     return authors
 
-def settext(object,key,node):
-    # find a better name for this.
-    if node != None :
-        if node.text != None :
-            object[key]=node.text
-
 def extract_type(article_node) :
-    for subj_group_node in findall_attrib(article_node,'subj-group','subj-group-type','heading') :
-        for subject_node in findall(subj_group_node,'subject') :
-            #print("REINOS: Found TYPE info in subj-group-heading subject: " + subject_node.text)
-            try:
-                if re.match("Poster Presentation|Editorial",subject_node.text) :
-                    #print("REINOS: this does not look like a research article")
-                    return 'Other'
-            except:
-                pass
+    return article_type(subject_node.text
+                        for subj_group_node in findall_attrib(article_node,'subj-group','subj-group-type','heading')
+                        for subject_node in findall(subj_group_node,'subject'))
+
+def article_type(heading_subjects) :
+    for subject in heading_subjects :
+        #print("REINOS: Found TYPE info in subj-group-heading subject: " + subject)
+        try:
+            if OTHER_TYPE_RE.match(subject) :
+                #print("REINOS: this does not look like a research article")
+                return 'Other'
+        except:
+            pass
     return 'Journal Article'
 
 def extract_pmcid(article_node):
@@ -287,48 +1129,251 @@ def extract_pmcid(article_node):
     Note: Location and formatting of PMCID in document has changed several times.'''
     return find_attrib(article_node,'article-id','pub-id-type','pmc-uid').text
 
-def extract_article(article_node) :
+
+def extract_article(article_node, extractor=None) :
     '''Take pmc xml article node and create simplified article object.'''
+    record = EXTRACTORS[extractor or SETTINGS['extractor']](article_node)
+    affs = build_affs(record.affs)
     article = {'found_all_harvard_auths': False,
                'found_any_harvard_auths': False,
-               'title':           catnode(find(article_node,'article-title')), #.text or "Untitled"
-               'journal':         find(article_node,'journal-title').text,
-               'type':            extract_type(article_node),
-               'pmcid':           extract_pmcid(article_node),
+               'title':           record.title,
+               'journal':         record.journal,
+               'type':            record.type,
+               'pmcid':           record.pmcid,
                'files':           [],
-               'issn':            find(article_node,'issn').text if find(article_node,'issn') else '',
-               'subjects':        extract_subjects(article_node),
-               'abstract':        extract_abstract(article_node),
-               'affs':            extract_affs(article_node),
+               'issn':            record.issn,
+               'subjects':        record.subjects,
+               'abstract':        record.abstract,
+               'affs':            affs,
                'version':         'Version of Record',
                'ldap_schools':    set(),
                'pmc_schools':     set(),
                'pmc_depts':       set(),
                'harvard_authors': [],
     }
-    print("REINOS: title: " + article['title'])
+    EXTRACT_LOG.debug("title: %s", article['title'])
+
+    article['authors'] = build_authors(record.authors,affs)
+
+    for key, value in (('doi', record.doi), ('publisher', record.publisher), ('volume', record.volume), ('issue', record.issue),
+                       ('fpage', record.fpage), ('lpage', record.lpage), ('elocation-id', record.elocation_id)) :
+        if value is not None :
+            article[key] = value
+
+    article['date'] = record.date
+    article['citation']=build_citation(article)
+    return article
+
+
+def extract_article_record(article_node) :
+    '''xpath extractor: one descendant search per field.'''
+    record = ArticleRecord(title=catnode(find(article_node,'article-title')), #.text or "Untitled"
+                           journal=find(article_node,'journal-title').text,
+                           type=extract_type(article_node),
+                           pmcid=extract_pmcid(article_node),
+                           issn=find(article_node,'issn').text if find(article_node,'issn') else '',
+                           subjects=extract_subjects(article_node),
+                           abstract=extract_abstract(article_node),
+                           affs=extract_affs(article_node),
+                           authors=extract_authors(article_node),
+                           doi=node_text(find_attrib(article_node,'article-id','pub-id-type','doi')),
+                           publisher=node_text(find(article_node,'publisher-name')),
+                           volume=node_text(find(article_node,'volume')),
+                           issue=node_text(find(article_node,'issue')),
+                           fpage=node_text(find(article_node,'fpage')),
+                           lpage=node_text(find(article_node,'lpage')),
+                           elocation_id=node_text(find(article_node,'elocation-id')))
 
     subtitle_node = find(article_node,'subtitle')
     if subtitle_node is not None:
-        print("FOUND SUBTITLE!")
-        article['title'] += ": " + catnode(subtitle_node)
-    else :
-        print("Did NOT find subtitle!")
+        EXTRACT_LOG.debug("found subtitle")
+        record.title += ": " + catnode(subtitle_node)
+
+    record.date = node_text(find(article_node,'copyright-year'))
+    if record.date is None:
+        record.date = find(article_node,'year').text
+    return record
+
+
+# elements whose first occurrence in a record is all the single pass extractor keeps.
+WALK_FIRST_TAGS = ('article-title', 'subtitle', 'journal-title', 'issn', 'publisher-name', 'volume', 'issue', 'fpage', 'lpage',
+                   'elocation-id', 'copyright-year', 'year')
+WALK_HANDLERS = {}
+UNSET = object()
+
+
+def walk_article_record(article_node) :
+    '''Single pass extractor: one walk over the record, dispatching on tag.
+
+    Keeps the xpath extractor's semantics: first descendant for single valued fields,
+    first surname/given-names/sup within each contrib/aff, and subjects by enclosing subj-group type.'''
+    walk = {'first': {}, 'ids': {}, 'affs': [], 'open_affs': [], 'authors': [], 'open_contribs': [], 'subj_groups': [],
+            'subjects': [], 'heading_subjects': [], 'kwd_groups': 0, 'keywords': [], 'abstracts': []}
+    handlers = walk_handlers()
+    for event, node in etree.iterwalk(article_node, events=('start', 'end'), tag=handlers['tags']) :
+        handlers[event][node.tag](walk, node)
+
+    first = walk['first']
+    title = catnode(first.get('article-title')) #.text or "Untitled"
+    if 'subtitle' in first :
+        EXTRACT_LOG.debug("found subtitle")
+        title += ": " + catnode(first['subtitle'])
+    issn_node = first.get('issn')
+    date = node_text(first.get('copyright-year'))
+    if date is None :
+        date = first.get('year').text
+    return ArticleRecord(title=title,
+                         journal=first.get('journal-title').text,
+                         type=article_type(walk['heading_subjects']),
+                         pmcid=walk['ids'].get('pmc-uid').text,
+                         # same element truth test as the xpath extractor: an issn has no children, so this is ''.
+                         issn=issn_node.text if issn_node is not None and len(issn_node) else '',
+                         subjects=build_subjects(walk['subjects'], walk['keywords']),
+                         abstract=abstract_text(walk['abstracts']),
+                         affs=walk['affs'],
+                         authors=walk['authors'],
+                         doi=node_text(walk['ids'].get('doi')),
+                         publisher=node_text(first.get('publisher-name')),
+                         volume=node_text(first.get('volume')),
+                         issue=node_text(first.get('issue')),
+                         fpage=node_text(first.get('fpage')),
+                         lpage=node_text(first.get('lpage')),
+                         elocation_id=node_text(first.get('elocation-id')),
+                         date=date)
+
+
+def walk_handlers():
+    '''Start and end handlers keyed on {ARTICLE_NS}tag, built once per namespace.'''
+    handlers = WALK_HANDLERS.get(ARTICLE_NS)
+    if handlers is None :
+        start = {tag: functools.partial(walk_first, tag) for tag in WALK_FIRST_TAGS}
+        start.update({'article-id': walk_article_id, 'aff': walk_aff_start, 'sup': walk_sup,
+                      'contrib': walk_contrib_start, 'surname': walk_surname, 'given-names': walk_given_names, 'xref': walk_xref,
+                      'subj-group': walk_subj_group_start, 'subject': walk_subject,
+                      'kwd-group': walk_kwd_group_start, 'kwd': walk_kwd, 'abstract': walk_abstract})
+        end = {'aff': walk_aff_end, 'contrib': walk_contrib_end, 'subj-group': walk_subj_group_end, 'kwd-group': walk_kwd_group_end}
+        qualify = lambda table: {'{{{}}}{}'.format(ARTICLE_NS, tag): handler for tag, handler in table.items()}
+        handlers = WALK_HANDLERS[ARTICLE_NS] = {'start': qualify(start), 'end': qualify(end)}
+        # iterwalk only reports tags with a start handler; give the rest a no-op end.
+        for tag in handlers['start'] :
+            handlers['end'].setdefault(tag, walk_ignore)
+        handlers['tags'] = list(handlers['start'])
+    return handlers
+
+
+def walk_ignore(walk, node):
+    pass
+
+
+def walk_first(tag, walk, node):
+    walk['first'].setdefault(tag, node)
+
+
+def walk_article_id(walk, node):
+    id_type = node.get('pub-id-type')
+    if id_type in ('pmc-uid', 'doi') :
+        walk['ids'].setdefault(id_type, node)
+
+
+def walk_aff_start(walk, node):
+    aff = AffRecord(node.attrib.get('id',None), UNSET, catnode(node))
+    walk['affs'].append(aff)
+    walk['open_affs'].append(aff)
+
+
+def walk_aff_end(walk, node):
+    aff = walk['open_affs'].pop()
+    if aff.sup is UNSET :
+        aff.sup = None
+
+
+def walk_sup(walk, node):
+    for aff in walk['open_affs'] :
+        if aff.sup is UNSET :
+            aff.sup = node.text
+
+
+def walk_contrib_start(walk, node):
+    author = None
+    # we filter out editors here.
+    if node.get('contrib-type') == 'author' :
+        author = AuthorRecord(UNSET, UNSET, [])
+        walk['authors'].append(author)
+    walk['open_contribs'].append(author)
 
-    article['authors'] = extract_authors(article_node,article['affs'])
 
-    settext(article,'doi',find_attrib(article_node,'article-id','pub-id-type','doi'))
-    settext(article,'publisher',find(article_node,'publisher-name'))
+def walk_contrib_end(walk, node):
+    author = walk['open_contribs'].pop()
+    if author is not None :
+        if author.last is UNSET :
+            author.last = None
+        if author.first is UNSET :
+            author.first = None
 
-    for key in ( 'volume','issue','fpage','lpage','elocation-id' ) :
-        settext(article,key,find(article_node,key))
 
-    settext(article,'date',find(article_node,'copyright-year'))
-    if 'date' not in article:
-        article['date'] = find(article_node,'year').text
+def walk_surname(walk, node):
+    for author in walk['open_contribs'] :
+        if author is not None and author.last is UNSET :
+            author.last = node.text
+
+
+def walk_given_names(walk, node):
+    for author in walk['open_contribs'] :
+        if author is not None and author.first is UNSET :
+            author.first = node.text
+
+
+def walk_xref(walk, node):
+    if node.get('ref-type') == 'aff' and 'rid' in node.attrib :
+        for author in walk['open_contribs'] :
+            if author is not None :
+                author.aff_ids.append(node.attrib['rid'])
+
+
+def walk_subj_group_start(walk, node):
+    walk['subj_groups'].append(node.get('subj-group-type'))
+
+
+def walk_subj_group_end(walk, node):
+    walk['subj_groups'].pop()
+
+
+def walk_subject(walk, node):
+    groups = walk['subj_groups']
+    if 'heading' in groups :
+        walk['heading_subjects'].append(node.text)
+    if any(group != 'heading' for group in groups) :
+        walk['subjects'].append(node.text)
+
+
+def walk_kwd_group_start(walk, node):
+    walk['kwd_groups'] += 1
+
+
+def walk_kwd_group_end(walk, node):
+    walk['kwd_groups'] -= 1
+
+
+def walk_kwd(walk, node):
+    if walk['kwd_groups'] :
+        walk['keywords'].append(node.text)
+
+
+def walk_abstract(walk, node):
+    walk['abstracts'].append(node)
+
+
+EXTRACTORS = {'xpath': extract_article_record, 'single-pass': walk_article_record}
 
-    article['citation']=build_citation(article)
-    return article
+
+def check_extractor(report,article_node,article):
+    '''Compare the extracted article against the other extractor's output for the same record.'''
+    other = 'single-pass' if SETTINGS['extractor'] == 'xpath' else 'xpath'
+    other_article = extract_article(article_node, other)
+    keys = sorted(key for key in set(article) | set(other_article) if article.get(key) != other_article.get(key))
+    if keys :
+        report['extractor_mismatches'] += 1
+        EXTRACT_LOG.warning("extractor mismatch on %s: %s", article['pmcid'], ", ".join(keys))
 
 
 def found_any_harvard_auths(article):
@@ -342,33 +1387,66 @@ def found_all_harvard_auths(article):
     return True
 
 def attach_authorities(article):
-    base_url = 'https://dash.harvard.edu/getBestMatch?format=json&'
+    attach_page_authorities([article])
+
+
+def attach_page_authorities(articles, report=None):
+    '''Look up authorities for every harvard author of the given articles.
+
+    All queries go out together over a pool of keep-alive connections; matches are then applied in author order.'''
+    lookups = []
+    for article in articles :
+        lookups.extend(prepare_authority_lookups(article))
+
+    cached = {}
+    if SETTINGS['authority_cache'] and not SETTINGS['refresh_authorities'] :
+        cached = read_authority_cache([lookup['key'] for lookup in lookups])
+    misses = [lookup for lookup in lookups if lookup['key'] not in cached]
+    if report is not None :
+        report['authority_cache_hits'] += len(lookups) - len(misses)
+        report['authority_cache_misses'] += len(misses)
+
+    fetched = dict(zip((lookup['key'] for lookup in misses), fetch_authority_json([lookup['url'] for lookup in misses])))
+    if SETTINGS['authority_cache'] :
+        write_authority_cache(fetched)
+    for lookup in lookups :
+        apply_authority_match(lookup, cached.get(lookup['key']) or fetched[lookup['key']])
+
+    for article in articles :
+        if article['found_any_harvard_auths'] :
+            article['found_all_harvard_auths']=True # tentative
+            for author in article['authors'] :
+                if author['has_harvard_affstring'] and author['authority'] == UNAFFILIATED :
+                    article['found_all_harvard_auths']=False
+                    break
+
+
+def prepare_authority_lookups(article):
+    '''Build the getBestMatch url for each harvard author of article and register its authority report entry.'''
+    base_url = SETTINGS['authority_url'] + '?format=json&'
 
     enc = urllib.parse.quote_plus
-    harvard_author_count=0
-    for author in article['authors']:
-        if author['has_harvard_affstring']:
-           harvard_author_count+=1
-    harvard_author_index=0
+    lookups = []
     for author in article['authors']:
         if not author['has_harvard_affstring']:
             continue
 
-        harvard_author_index += 1
+        # just the author report columns: entries travel back from workers and into the checkpoint.
         AR={ 'title': article['title'],
              'pmcid': article['pmcid'],
-             'harvard_author_count': harvard_author_count,
-             'harvard_author_index': harvard_author_index,
-             'all_authors': len(article['authors']),
-             'pmc_author': author
+             'first': author['first'],
+             'last': author['last'],
+             'affstring': "|".join(aff['text'] for aff in author.get('affs', [])),
+             'label': 'NO MATCH',
+             'confidence': 0.0,
         }
         AUTHORITY_REPORT.append(AR)
 
         title_value=""
         afftexts=""
         for afftext in author['afftexts']:
-            print("REINOS: afftext: " + afftext)
-            afftext = re.sub('^[ß1234567890]','',afftext)
+            AUTHORITY_LOG.debug("afftext: %s", afftext)
+            afftext = AFF_LABEL_RE.sub('',afftext)
             afftexts+=afftext
             title_value+=afftext
 
@@ -388,15 +1466,12 @@ def attach_authorities(article):
         # temporary hack to deal with Peter aka Phillip Kraft
         if first == 'Peter' and last == 'Kraft' :
             first = 'Phillip'
-            print("REINOS: GOT IT!")
-
-        title_value = re.sub("broad institute of harvard and massachusetts institute of technology", "",title_value)
-        title_value = re.sub("broad institute of harvard", "",title_value)
-        title_value = re.sub("massachusetts institute of technology", "",title_value)
-        title_value = re.sub("harvard|\d+|cambridge|massachusetts|\,|hospital|united states of america|department of|boston|huntington|avenue|kresge| ma | usa|brigham and women\’s|medical school","",title_value)
-        title_value = re.sub("school of [^,]+","",title_value)
-        title_value = re.sub(" +"," ",title_value)
-        print("REINOS: title_value: " + title_value)
+            AUTHORITY_LOG.debug("looking up Peter Kraft as Phillip Kraft")
+
+        for scrub in TITLE_SCRUBS :
+            title_value = scrub.sub("",title_value)
+        title_value = SPACES_RE.sub(" ",title_value)
+        AUTHORITY_LOG.debug("title_value: %s", title_value)
         if len(nameparts) > 1 :
             middle = nameparts[1]
         url = "{base_url}surname={last}&givenname={first}&school={school}&title={title}".format(
@@ -407,37 +1482,191 @@ def attach_authorities(article):
         dept_value = bulklib.findit("department of ([\w ]+)",afftexts)
         # skip departments for now.
         if dept_value :
-            print("REINOS: got a department!" + dept_value)
+            AUTHORITY_LOG.debug("got a department: %s", dept_value)
             url+= "&department=" + enc(dept_value)
-        print("REINOS: fetching author huid lookup url: " + url)
-        # Investigate why this is ISO-8859-1 instead of utf-8
-        json_string = urllib.request.urlopen(url).read().decode('ISO-8859-1')
-        print("REINOS: got this json string: " + json_string)
-        json_authors = json.loads(json_string)['choices']
-        AR['json_url']= url
-        AR['ldap_authors']=json_authors
-        AR['pmcid']=article['pmcid']
-        author['match_count'] = len(json_authors)
-        print("REINOS: got this many json authors: " + str(len(json_authors)))
-        best_json_author = get_best_json_author(json_authors)
-        if best_json_author :
-            print("REINOS: got a best author: " + str(best_json_author['confidence']))
-            AR['best_match_author'] = best_json_author
-            author['authority'] = best_json_author['authority']
-            article['harvard_authors'].append(author)
-            article['found_any_harvard_auths']=True
-            try:
-                for school in best_json_author['schools'] :
-                    add_ldap_school(article,author,school)
-            except:
-                pass
+        query = {'surname': last, 'givenname': first, 'middlename': middle, 'school': school_value, 'title': title_value, 'department': dept_value or ''}
+        lookups.append({'article': article, 'author': author, 'AR': AR, 'url': url, 'key': authority_cache_key(query)})
+    return lookups
+
+
+def authority_cache_key(query):
+    '''Normalize getBestMatch query parameters into a cache key.
+
+    The key includes the endpoint, so that lookups against a test or stand-in service never answer for the real one.'''
+    normalized = {'endpoint': SETTINGS['authority_url']}
+    for name, value in query.items():
+        value = WHITESPACE_RE.sub(" ", str(value or '')).strip().lower()
+        if name == 'school' :
+            # school order comes from set iteration and means nothing.
+            value = ",".join(sorted(value.split(",")))
+        normalized[name] = value
+    return json.dumps(normalized, sort_keys=True)
+
+
+def apply_authority_match(lookup, json_string):
+    article = lookup['article']
+    author = lookup['author']
+    AR = lookup['AR']
+    url = lookup['url']
+    AUTHORITY_LOG.debug("got this json string: %s", json_string)
+    json_authors = json.loads(json_string)['choices']
+    AR['json_url']= url
+    AR['match_count']=len(json_authors)
+    author['match_count'] = len(json_authors)
+    AUTHORITY_LOG.debug("got %d json authors", len(json_authors))
+    best_json_author = get_best_json_author(json_authors)
+    if best_json_author :
+        AUTHORITY_LOG.debug("got a best author: %s", best_json_author['confidence'])
+        AR['label'] = best_json_author['label']
+        AR['confidence'] = best_json_author['confidence']
+        author['authority'] = best_json_author['authority']
+        article['harvard_authors'].append(author)
+        article['found_any_harvard_auths']=True
+        try:
+            for school in best_json_author['schools'] :
+                add_ldap_school(article,author,school)
+        except:
+            pass
+
+
+def connect_shared_db(path):
+    '''Connect to one of the sqlite stores shared by all runs (authority cache, fingerprints, article store index).
+
+    They keep sqlite's rollback journal: WAL needs memory shared on one host, and --shard runs on several hosts
+    open the same files. Setting it also takes a store out of WAL if an older run left it there.'''
+    db = sqlite3.connect(path, timeout=60)
+    db.execute('PRAGMA journal_mode=DELETE')
+    return db
+
+
+def authority_cache_db():
+    '''Open (once per process) the sqlite cache of getBestMatch responses shared by all runs.'''
+    global AUTHORITY_CACHE_DB
+    if AUTHORITY_CACHE_DB is None :
+        cache_dir = os.path.dirname(SETTINGS['authority_cache'])
+        if cache_dir and not os.path.exists(cache_dir) :
+            os.makedirs(cache_dir)
+        AUTHORITY_CACHE_DB = connect_shared_db(SETTINGS['authority_cache'])
+        AUTHORITY_CACHE_DB.execute('CREATE TABLE IF NOT EXISTS authorities (key TEXT PRIMARY KEY, json TEXT, fetched REAL, used REAL)')
+        AUTHORITY_CACHE_DB.execute('CREATE INDEX IF NOT EXISTS authorities_used ON authorities (used)')
+    return AUTHORITY_CACHE_DB
+
+
+def read_authority_cache(keys):
+    '''Return {key: json_string} for the keys with an unexpired cached response, marking them as used.'''
+    db = authority_cache_db()
+    now = time.time()
+    oldest = now - SETTINGS['authority_cache_ttl'] * 86400
+    found = {}
+    for key in set(keys) :
+        row = db.execute('SELECT json FROM authorities WHERE key = ? AND fetched >= ?', (key, oldest)).fetchone()
+        if row :
+            found[key] = row[0]
+    with db :
+        db.executemany('UPDATE authorities SET used = ? WHERE key = ?', ((now, key) for key in found))
+    return found
+
+
+def write_authority_cache(json_strings):
+    now = time.time()
+    with authority_cache_db() as db :
+        db.executemany('INSERT OR REPLACE INTO authorities (key, json, fetched, used) VALUES (?, ?, ?, ?)',
+                       ((key, json_string, now, now) for key, json_string in json_strings.items()))
+
+
+def fingerprint_db():
+    '''Open (once per process) the store of record fingerprints, by pmcid, shared by all runs.'''
+    global FINGERPRINT_DB
+    if FINGERPRINT_DB is None :
+        store_dir = os.path.dirname(SETTINGS['fingerprints'])
+        if store_dir and not os.path.exists(store_dir) :
+            os.makedirs(store_dir)
+        FINGERPRINT_DB = connect_shared_db(SETTINGS['fingerprints'])
+        FINGERPRINT_DB.execute('CREATE TABLE IF NOT EXISTS fingerprints (pmcid TEXT PRIMARY KEY, fingerprint TEXT, batch TEXT, recorded REAL)')
+    return FINGERPRINT_DB
+
+
+def read_fingerprint(pmcid, batch):
+    '''The sha1 of the metadata of the last settled version of a record, if any.
+
+    Fingerprints recorded by batch itself do not count, so that rerunning a batch from scratch rebuilds
+    the output it wiped rather than skipping it.'''
+    row = fingerprint_db().execute('SELECT fingerprint FROM fingerprints WHERE pmcid = ? AND batch != ?', (pmcid, batch)).fetchone()
+    return row[0] if row else None
+
+
+def write_fingerprints(batch, fingerprints):
+    '''Record (pmcid, fingerprint) pairs of articles that were found in dash.'''
+    now = time.time()
+    with fingerprint_db() as db :
+        db.executemany('INSERT OR REPLACE INTO fingerprints (pmcid, fingerprint, batch, recorded) VALUES (?, ?, ?, ?)',
+                       ((pmcid, fingerprint, batch, now) for pmcid, fingerprint in fingerprints))
+
+
+def trim_authority_cache():
+    '''Drop expired responses, then least recently used ones beyond the size cap.'''
+    with authority_cache_db() as db :
+        db.execute('DELETE FROM authorities WHERE fetched < ?', (time.time() - SETTINGS['authority_cache_ttl'] * 86400,))
+        excess = db.execute('SELECT COUNT(*) FROM authorities').fetchone()[0] - SETTINGS['authority_cache_size']
+        if excess > 0 :
+            AUTHORITY_LOG.info("Evicting %d least recently used authority cache entries", excess)
+            db.execute('DELETE FROM authorities WHERE key IN (SELECT key FROM authorities ORDER BY used LIMIT ?)', (excess,))
+
+
+def fetch_authority_json(urls):
+    '''Fetch getBestMatch json strings for urls concurrently, returned in url order.'''
+    if not urls :
+        return []
+    global AUTHORITY_EXECUTOR
+    if AUTHORITY_EXECUTOR is None :
+        AUTHORITY_EXECUTOR = concurrent.futures.ThreadPoolExecutor(SETTINGS['authority_concurrency'])
+    return list(AUTHORITY_EXECUTOR.map(fetch_authority_url, urls))
+
+
+def fetch_authority_url(url):
+    '''GET url on this thread's keep-alive connection, retrying with exponential backoff.'''
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path + '?' + parts.query
+    retries = SETTINGS['authority_retries']
+    attempt = 0
+    while True :
+        AUTHORITY_LOG.debug("fetching author huid lookup url: %s", url)
+        connection = authority_connection(parts.scheme, parts.netloc)
+        reused = connection.sock is not None
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            body = response.read()
+            if response.status != 200 :
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+            # Investigate why this is ISO-8859-1 instead of utf-8
+            return body.decode('ISO-8859-1')
+        except (OSError, http.client.HTTPException) as e:
+            connection.close()
+            del AUTHORITY_CONNECTIONS.by_host[(parts.scheme, parts.netloc)]
+            if reused and isinstance(e, (http.client.BadStatusLine, ConnectionResetError, BrokenPipeError)) :
+                # the server closed the keep-alive connection while it sat idle (KeepAliveTimeout):
+                # not a failure, so resend at once on a fresh connection, which is not reused and gets no second pass.
+                AUTHORITY_LOG.debug("keep-alive connection closed by server (%s), reconnecting", e)
+                continue
+            if attempt == retries :
+                raise
+            delay = SETTINGS['authority_backoff'] * 2 ** attempt
+            AUTHORITY_LOG.warning("author lookup failed (%s), retrying in %ss", e, delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+def authority_connection(scheme, netloc):
+    # one connection per host per thread, so http.client can keep it alive between requests.
+    if not hasattr(AUTHORITY_CONNECTIONS, 'by_host') :
+        AUTHORITY_CONNECTIONS.by_host = {}
+    key = (scheme, netloc)
+    if key not in AUTHORITY_CONNECTIONS.by_host :
+        connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        AUTHORITY_CONNECTIONS.by_host[key] = connection_class(netloc, timeout=SETTINGS['authority_timeout'])
+    return AUTHORITY_CONNECTIONS.by_host[key]
 
-    if article['found_any_harvard_auths'] :
-        article['found_all_harvard_auths']=True # tentative
-        for author in article['authors'] :
-            if author['has_harvard_affstring'] and author['authority'] == UNAFFILIATED :
-                article['found_all_harvard_auths']=False
-                return
 
 def get_best_json_author(json_authors) :
     bja = None
@@ -457,7 +1686,7 @@ def get_best_json_author(json_authors) :
 
 def add_pmc_school(article,author,school,afftext) :
     # these are schools based on pmc affiliation text.
-    print("REINOS: adding pmc school: " + school)
+    SCHOOL_LOG.debug("adding pmc school: %s", school)
     article['pmc_schools'].add(school)
     author['pmc_schools'].add(school)
     author['afftexts'].append(afftext)
@@ -468,47 +1697,71 @@ def add_ldap_school(article,author,school):
     article['ldap_schools'].add(school)
     author['ldap_schools'].add(school)
 
-def assign_article_schools(article,fas_depts) :
+def build_school_classifier(fas_depts):
+    '''Compile the affiliation school patterns and the fas department list once per run.'''
+    return {'schools': first_listed_pattern(pattern for school, pattern in SCHOOL_PATTERNS),
+            'fas_depts': list(fas_depts),
+            'depts': first_listed_pattern(dept.lower() for dept in fas_depts)}
+
+
+def first_listed_pattern(alternatives):
+    '''Compile alternatives into one pattern that a single scan can test for all of them.
+
+    Each alternative sits in its own group inside a lookahead, so every position in the text
+    reports the first listed alternative that matches there.'''
+    alternatives = list(alternatives)
+    if not alternatives :
+        return None
+    group_index = {}
+    group = 1
+    for i, alternative in enumerate(alternatives) :
+        group_index[group] = i
+        group += 1 + re.compile(alternative).groups
+    return {'regex': re.compile("(?=" + "|".join("(" + a + ")" for a in alternatives) + ")"), 'group_index': group_index}
+
+
+def first_listed_match(pattern, text):
+    '''Index of the first listed alternative of pattern found anywhere in text, or None.'''
+    first = None
+    if pattern is None :
+        return first
+    for match in pattern['regex'].finditer(text) :
+        # lastindex is the alternative's own group, even when the alternative has groups of its own.
+        i = pattern['group_index'][match.lastindex]
+        if first is None or i < first :
+            first = i
+            if first == 0 :
+                break
+    return first
+
+
+def assign_article_schools(article,classifier) :
     # primitive assignment of article to schools based on author affiliation string.
     for author in article['authors'] :
         author['pmc_schools']=set()
         author['afftexts']=[]
         for aff in author['affs'] :
             afftext=aff['text'].lower()
-            afftext = re.sub("harvard\.edu","",afftext) # remove emails as basis for affiliation.
+            afftext = HARVARD_EMAIL_RE.sub("",afftext) # remove emails as basis for affiliation.
             #author['afftext']+=afftext
-            print("REINOS_X: afftext: " + afftext)
-            if re.match(".*(harvard medical school|harvard university school of medicine|beth israel deaconess medical center|brigham and women\’s hospital|massachusetts general hospital).*",afftext) :
-                add_pmc_school(article,author,'HMS',afftext)
-            elif re.match(".*harvard school of public health.*",afftext) :
-                # does changing HSPH to SPH matter here?
-                #add_pmc_school(article,author,'HSPH',afftext)
-                add_pmc_school(article,author,'SPH',afftext)
-            elif re.match(".*harvard graduate school of education.*",afftext) :
-                add_pmc_school(article,author,'GSE',afftext)
-            elif re.match(".*harvard university.*",afftext) :
-                print("FAS afftext: " + afftext)
-                print(author)
-                for dept in fas_depts :
-                    clean_dept    = dept.lower()
-                    clean_afftext = re.sub("\&","and",afftext)
-                    if re.match(".*"+ clean_dept +".*",clean_afftext) :
-                        print("REINOS: FAS DEPT: " + dept)
-                        article['pmc_depts'].add(dept)
-                        break
-                if len(article['pmc_depts']) > 0 :
-                    add_pmc_school(article,author,'FAS',afftext)
-                else :
+            SCHOOL_LOG.debug("afftext: %s", afftext)
+            school_index = first_listed_match(classifier['schools'],afftext)
+            if school_index is None :
+                SCHOOL_LOG.debug("no harvard aff match")
+                continue
+            school = SCHOOL_PATTERNS[school_index][0]
+            if school == 'FAS' :
+                SCHOOL_LOG.debug("FAS afftext: %s (author: %s)", afftext, author)
+                dept_index = first_listed_match(classifier['depts'],afftext.replace("&","and"))
+                if dept_index is not None :
+                    dept = classifier['fas_depts'][dept_index]
+                    SCHOOL_LOG.debug("FAS dept: %s", dept)
+                    article['pmc_depts'].add(dept)
+                if len(article['pmc_depts']) == 0 :
                     # no idea what school to attach this author to. maybe ldap will tell us...
-                    add_pmc_school(article,author,'',afftext)
-            elif re.match(".*harvard.*",afftext) :
-                add_pmc_school(article,author,'',afftext)
-            else :
-                print("REINOS_X: NO HARVARD AFF MATCH!")
-    print("pmc schools:")
-    print(article['pmc_schools'])
-    print("pmc departments:")
-    print(article['pmc_depts'])
+                    school = ''
+            add_pmc_school(article,author,school,afftext)
+    SCHOOL_LOG.debug("pmc schools: %s, pmc departments: %s", article['pmc_schools'], article['pmc_depts'])
 
 
 def format_first(author,initialize = False) :
@@ -538,17 +1791,15 @@ def build_citation(article):
         else :
             if i == len(article['authors']) :
                 if citation[-4] == ' ' :
-                    citation = re.sub(", $","., ",citation)
+                    citation = CITATION_TRAILING_COMMA_RE.sub("., ",citation)
                 citation += "and "
             citation+= "{} {}, ".format(format_first(author,et_al), author['last'])
         i+=1
     citation += ". {}. “{}.” ".format(article['date'], article['title'])
 
     citation += article['journal'] + " "
-    citation = re.sub(", \.", ".", citation)
-    citation = re.sub("\.\.",".",citation)
-    citation = re.sub("\s+"," ",citation)
-    citation = re.sub("\?\.","?",citation)
+    for pattern, replacement in CITATION_CLEANUPS :
+        citation = pattern.sub(replacement, citation)
     if 'volume' in article :
         citation += article['volume']
         if 'issue' not in article :
@@ -573,7 +1824,7 @@ def build_citation(article):
 
     # question: how do elocation ids play with dois?
     if 'elocation-id' in article :
-        print("REINOS: HOT DOG! sticking elocation-id into citation")
+        EXTRACT_LOG.debug("sticking elocation-id into citation")
         # Chicago Style dictates a space after the colon if there is an issue number in parentheses, NO space if there is no issue number
         # -- Emily Andersen
         citation += ":"
@@ -588,58 +1839,50 @@ def build_citation(article):
         citation += ". http://dx.doi.org/" + article['doi']
 
 
-    citation = re.sub(" +"," ",citation)
-    citation = re.sub(" ,",",",citation)
+    citation = SPACES_RE.sub(" ",citation)
+    citation = CITATION_SPACE_COMMA_RE.sub(",",citation)
     citation += '.'
 
-    print("REINOS: CITATION: " + citation)
+    EXTRACT_LOG.debug("citation: %s", citation)
 
-    # test a few citations vs. slightly tweaked dash crossref api output.
-    doi2citation={}
-    doi2citation['10.2337/dc11-2420']="Beer, N. L., K. K. Osbak, M. van de Bunt, N. D. Tribble, A. M. Steele, K. J. Wensley, E. L. Edghill, et al. 2012. “Insights Into the Pathogenicity of Rare Missense GCK Variants From the Identification and Functional Characterization of Compound Heterozygous and Double Mutations Inherited in Cis.” Diabetes Care 35 (7): 1482-1484. doi:10.2337/dc11-2420. http://dx.doi.org/10.2337/dc11-2420."
-    doi2citation['10.2337/dc12-0073']="Cozma, A. I., J. L. Sievenpiper, R. J. de Souza, L. Chiavaroli, V. Ha, D. D. Wang, A. Mirrahimi, et al. 2012. “Effect of Fructose on Glycemic Control in Diabetes: A systematic review and meta-analysis of controlled feeding trials.” Diabetes Care 35 (7): 1611-1620. doi:10.2337/dc12-0073. http://dx.doi.org/10.2337/dc12-0073."
-    doi2citation['10.1186/2045-5380-3-12']="Huys, Quentin JM, Diego A Pizzagalli, Ryan Bogdan, and Peter Dayan. 2013. “Mapping anhedonia onto reinforcement learning: a behavioural meta-analysis.” Biology of Mood & Anxiety Disorders 3 (1): 12. doi:10.1186/2045-5380-3-12. http://dx.doi.org/10.1186/2045-5380-3-12."
-    doi2citation['10.2337/db11-0134']="Azzi, J., R. F. Moore, W. Elyaman, M. Mounayar, N. El Haddad, S. Yang, M. Jurewicz, et al. 2012. “The Novel Therapeutic Effect of Phosphoinositide 3-Kinase-γ Inhibitor AS605240 in Autoimmune Diabetes.” Diabetes 61 (6): 1509-1518. doi:10.2337/db11-0134. http://dx.doi.org/10.2337/db11-0134."
-    doi2citation['10.2337/db11-1296']="Haiman, C. A., M. D. Fesinmeyer, K. L. Spencer, P. Bůžková, V. S. Voruganti, P. Wan, J. Haessler, et al. 2012. “Consistent Directions of Effect for Established Type 2 Diabetes Risk Variants Across Populations: The Population Architecture using Genomics and Epidemiology (PAGE) Consortium.” Diabetes 61 (6): 1642-1647. doi:10.2337/db11-1296. http://dx.doi.org/10.2337/db11-1296."
-    doi2citation['10.1371/journal.pone.0067405']="Palmsten, Kristin, Krista F. Huybrechts, Helen Mogun, Mary K. Kowal, Paige L. Williams, Karin B. Michels, Soko Setoguchi, and Sonia Hernández-Díaz. 2013. “Harnessing the Medicaid Analytic eXtract (MAX) to Evaluate Medications in Pregnancy: Design Considerations.” PLoS ONE 8 (6): e67405. doi:10.1371/journal.pone.0067405. http://dx.doi.org/10.1371/journal.pone.0067405."
-    doi2citation['10.1111/nyas.12031']="Weir, Gordon C., and Susan Bonner-Weir. 2013. “Islet β cell mass in diabetes and how it relates to function, birth, and death.” Annals of the New York Academy of Sciences 1281 (1): 92-105. doi:10.1111/nyas.12031. http://dx.doi.org/10.1111/nyas.12031."
-
-    doi2citation['10.4081/hi.2011.e14']="Huffman, Jeff C., Carol A. Mastromauro, Julia K. Boehm, Rita Seabrook, Gregory L. Fricchione, John W. Denninger, and Sonja Lyubomirsky. 2011. “Development of a positive psychology intervention for patients with acute cardiovascular disease.” Heart International 6 (2): e14. doi:10.4081/hi.2011.e14. http://dx.doi.org/10.4081/hi.2011.e14."
-
-    if 'doi' in article and article['doi'] in doi2citation:
-        c = doi2citation[article['doi']]
-        if citation == c :
-            print("REINOS_SUCCESS")
-        else :
-            print("REINOS_FAILURE")
-            print("REINOS: Shouldbe: " +c)
-            exit()
+    return citation
 
 
-    return citation
+def check_citation(report,article):
+    expected = CITATION_CHECKS.get(article.get('doi'))
+    if expected is None :
+        return
+    if article['citation'] == expected :
+        EXTRACT_LOG.debug("citation check passed for doi %s", article['doi'])
+    else :
+        report['citation_mismatches'] += 1
+        EXTRACT_LOG.error("citation check failed for doi %s: %s should be: %s", article['doi'], article['citation'], expected)
 
 
 def extract_subjects(article_node) :
     # really irritating. there are all these "heading" subjects.
-    subjects = []
+    subject_groups = [node for node in findall(article_node,'subj-group') if node.attrib.get('subj-group-type') != 'heading']
+    return build_subjects((subject_node.text for subject_group_node in subject_groups for subject_node in findall(subject_group_node,'subject')),
+                          (kwd_node.text for kwd_group_node in findall(article_node,'kwd-group') for kwd_node in findall(kwd_group_node,'kwd')))
 
-    for subject_group_node in findall(article_node,'subj-group') :
-        if 'subj-group-type' in subject_group_node.attrib :
-            if subject_group_node.attrib['subj-group-type'] == 'heading' :
-                continue
-        for subject_node in findall(subject_group_node,'subject') :
-            # crappy "heading" subjects still sometimes get through.
-            if not re.match("Research|Letter|Communication|Dispatch|Tools|Original Research|\d+",subject_node.text) :
-                if subject_node.text not in subjects :
-                    subjects.append(subject_node.text)
+
+def build_subjects(subject_texts, keyword_texts) :
+    subjects = []
+    seen = set()
+    for text in subject_texts :
+        # crappy "heading" subjects still sometimes get through.
+        if not HEADING_SUBJECT_RE.match(text) :
+            if text not in seen :
+                subjects.append(text)
+                seen.add(text)
 
     # stuff keywords into subject as well if available. (Emily Anderson request)
-    for kwd_group_node in findall(article_node,'kwd-group') :
-        for kwd_node in findall(kwd_group_node,'kwd') :
-            if kwd_node.text not in subjects and kwd_node.text != None :
-                # remove parenthesized numeric subject codes.
-                keyword = re.sub("^\(\d+\.\d+\)","",kwd_node.text)
-                subjects.append(keyword)
+    for text in keyword_texts :
+        if text not in seen and text != None :
+            # remove parenthesized numeric subject codes.
+            keyword = SUBJECT_CODE_RE.sub("",text)
+            subjects.append(keyword)
+            seen.add(keyword)
 
     return subjects
 
@@ -656,14 +1899,17 @@ def catnode(node):
     '''Concatenate text for all subnotes, with whitespace cleanup.'''
     cattext=""
     for text in node.itertext() :
-        text = re.sub("\s+"," ",text)
+        text = WHITESPACE_RE.sub(" ",text)
         cattext+=text
     return cattext.strip()
 
 
 def extract_abstract(article_node):
+    return abstract_text(findall(article_node,'abstract'))
+
+
+def abstract_text(abstract_nodes):
     # complex because in a bunch of subnodes. this method is crude.
-    abstract_nodes =findall(article_node,'abstract')
     abstract_node = None
 
     if len(abstract_nodes) == 1 :
@@ -673,40 +1919,107 @@ def extract_abstract(article_node):
         # mulitiple abstracts: take the "normal," unqualified abstract (not the precis, toc etc.)
         for node in abstract_nodes:
             if 'abstract-type' in node.attrib :
-                print("REINOS: dodging abstract: " + node.attrib['abstract-type'])
+                EXTRACT_LOG.debug("dodging abstract: %s", node.attrib['abstract-type'])
             else :
-                print("REINOS: assigning unqualified abstract.")
+                EXTRACT_LOG.debug("assigning unqualified abstract")
                 abstract_node = node
 
     abstract = ""
-    regex = re.compile(
-        r"(" + r"|".join(
-            (r"Author Summary", r"Background", r"Case presentation", r"Conclusion", r"Conclusions", r"Conclusions\/Significance",
-             r"Design", "eLife digest", "Findings", "IMPORTANCE", "Introduction",
-             r"Main Outcome Measures?", r"Main Results", r"Methods(?: (?:&|and) (?:(?:(?:Principal )?Findings)|Results))?", r"Methods\/Findings",
-             r"Objectives?", r"Participants", r"Rationale", r"Research Design & Methods", r"Results", "Setting(?: and Participants)?",)
-        ) + r")$") # end regex = assignment
 
     if abstract_node is not None:
         for text in abstract_node.itertext() :
             abstract += text
 
-            if regex.match(text):
+            if ABSTRACT_HEADING_RE.match(text):
                 # a bit hacky. should really add colon after "title" elements in abstact.
                 abstract+=":"
-    abstract = re.sub("\s+"," ",abstract)
+    abstract = WHITESPACE_RE.sub(" ",abstract)
 
     return abstract.strip()
 
 
-def already_in_dash(article,dash_dois,dash_titles,dash_pmcids) :
-    # first cut at duplicate detection.
+def ldap2dash_school():
+    if 'ldap2dash_school' not in REFERENCE_DATA :
+        REFERENCE_DATA['ldap2dash_school'] = {v:k for k, v in reference_data('dash2ldap_school', bulklib.load_dash2ldap_school).items()}
+    return REFERENCE_DATA['ldap2dash_school']
+
+
+def fas_departments():
+    return reference_data('fas_departments', bulklib.load_fas_departments)
+
+
+def reference_data(name, loader):
+    '''Reference data from a bulklib loader, read once per process from a pickle snapshot that is reloaded
+    from bulklib when bulklib or the ingest tsv data change.'''
+    if name not in REFERENCE_DATA :
+        path = os.path.join(SETTINGS['reference_cache'], name + '.pickle')
+        snapshot = None
+        if not SETTINGS['refresh_reference'] and os.path.exists(path) :
+            try:
+                with open(path, 'rb') as f :
+                    snapshot = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError) as e:
+                LOG.warning("Ignoring unreadable reference snapshot %s: %s", path, e)
+        if snapshot and snapshot.get('version') == REFERENCE_SNAPSHOT_VERSION and snapshot.get('signature') == reference_signature() :
+            REFERENCE_DATA[name] = snapshot['data']
+        else :
+            LOG.info("Loading %s from bulklib", name)
+            REFERENCE_DATA[name] = loader()
+            write_reference_snapshot(path, {'version': REFERENCE_SNAPSHOT_VERSION, 'signature': reference_signature(), 'data': REFERENCE_DATA[name]})
+    return REFERENCE_DATA[name]
+
+
+def reference_signature():
+    '''mtime and size of bulklib and of the ingest tsv files, which the reference and dash holdings loaders read.'''
+    global REFERENCE_SIGNATURE
+    if REFERENCE_SIGNATURE is None :
+        REFERENCE_SIGNATURE = dashindex.source_signature(bulklib)
+    return REFERENCE_SIGNATURE
+
+
+def write_reference_snapshot(path, snapshot):
+    snapshot_dir = os.path.dirname(path)
+    if not os.path.exists(snapshot_dir) :
+        os.makedirs(snapshot_dir)
+    fd, tmppath = tempfile.mkstemp(suffix='.tmp', dir=snapshot_dir)
+    with os.fdopen(fd, 'wb') as f :
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.chmod(tmppath, 0o644)
+    os.replace(tmppath, path)
+
+
+def load_dash_index(rebuild=False):
+    '''Open the dash holdings index, building it from the bulklib loaders if missing, out of date or asked to.
+
+    The index is a snapshot of bulklib data like the reference snapshots, and goes out of date the same way:
+    when the files the loaders read change. --refresh-reference rebuilds it along with them.'''
+    path = SETTINGS['dash_index']
+    source = dashindex.source_digest(reference_signature())
+    index = None
+    if not (rebuild or SETTINGS['refresh_reference']) and os.path.exists(path) :
+        try:
+            index = dashindex.open_index(path)
+        except ValueError as e:
+            LOG.warning("Rebuilding unreadable dash holdings index: %s", e)
+        if index is not None and index['source'] != source :
+            LOG.info("Dash holdings changed since the index was built")
+            dashindex.close_index(index)
+            index = None
+    if index is None :
+        LOG.info("Building dash holdings index: %s", path)
+        dashindex.build_index(path, bulklib.load_dash_dois(), bulklib.load_dash_titles(), bulklib.load_dash_pmcids(), source)
+        index = dashindex.open_index(path)
+    return index
+
+
+def already_in_dash(article,dash_index) :
+    # first cut at duplicate detection. titles are compared normalized (case, accents, punctuation, whitespace).
     found = False
-    if 'doi' in article and article['doi'] in dash_dois :
+    if 'doi' in article and dashindex.contains(dash_index, 'doi', article['doi']) :
         found = True
-    if article['pmcid'] in dash_pmcids :
+    if dashindex.contains(dash_index, 'pmcid', article['pmcid']) :
         found = True
-    if article['title'] in dash_titles :
+    if dashindex.contains(dash_index, 'title', article['title']) :
         found = True
     return found
 
@@ -715,13 +2028,13 @@ def get_target_collection_dir(article):
     '''build the collection directory name based on LDAP schools with fallback to PMC schools (converted to dash school naming convention).'''
     schools = []
     for ldap_school in sorted(article['ldap_schools']) :
-        if ldap_school in LDAP2DASH_SCHOOL :
-            schools.append(LDAP2DASH_SCHOOL[ldap_school])
+        if ldap_school in ldap2dash_school() :
+            schools.append(ldap2dash_school()[ldap_school])
         else:
-            print("REINOS: hey! no DASH school for LDAP school: " + ldap_school)
+            OUTPUT_LOG.warning("no DASH school for LDAP school: %s", ldap_school)
 
     if not schools :
-        print("No LDAP schools... let's try PMC schools")
+        OUTPUT_LOG.debug("no LDAP schools, trying PMC schools")
         for pmc_school in sorted(article['pmc_schools']) :
             schools.append(pmc_school)
 
@@ -729,6 +2042,32 @@ def get_target_collection_dir(article):
     return collection
 
 
+def download_page_files(articles, batch):
+    '''Download files for articles over a small pool of connections, paced by the download token bucket.'''
+    global DOWNLOAD_EXECUTOR
+    if DOWNLOAD_EXECUTOR is None :
+        DOWNLOAD_EXECUTOR = concurrent.futures.ThreadPoolExecutor(SETTINGS['download_concurrency'])
+    list(DOWNLOAD_EXECUTOR.map(functools.partial(download_files, batch=batch), articles))
+
+
+def take_download_token():
+    '''Block until the download token bucket allows another request to ncbi.'''
+    rate = SETTINGS['download_rate']
+    burst = SETTINGS['download_burst']
+    with DOWNLOAD_BUCKET['lock'] :
+        now = time.monotonic()
+        if DOWNLOAD_BUCKET['stamp'] is None :
+            DOWNLOAD_BUCKET['tokens'] = burst
+        else :
+            DOWNLOAD_BUCKET['tokens'] = min(burst, DOWNLOAD_BUCKET['tokens'] + (now - DOWNLOAD_BUCKET['stamp']) * rate)
+        DOWNLOAD_BUCKET['stamp'] = now
+        # take the token now, even if that leaves the bucket in debt, so waiting threads queue up in order.
+        DOWNLOAD_BUCKET['tokens'] -= 1
+        wait = -DOWNLOAD_BUCKET['tokens'] / rate if DOWNLOAD_BUCKET['tokens'] < 0 else 0
+    if wait > 0 :
+        time.sleep(wait)
+
+
 def download_files(article, batch):
     # TODO: replace with FTP
     # TODO: handle non-pdf articles
@@ -739,33 +2078,151 @@ def download_files(article, batch):
             'name': article['pmcid']+'.pdf'}
 
     cachepath = os.path.join(DATA_DIR, "batch", batch, "articles")
-    if not os.path.exists(cachepath):
-        os.mkdir(cachepath)
+    os.makedirs(cachepath, exist_ok=True)
     file['cachepath']  =  os.path.join(cachepath, file['name'])
     errorpath = file['cachepath'] + ".error"
     if ( os.path.exists(file['cachepath']) or os.path.exists(errorpath) ):
-        print("Article file in cache...");
+        DOWNLOAD_LOG.debug("Article file in cache: %s", file['cachepath'])
+        if SETTINGS['article_store'] and os.path.exists(file['cachepath']) and not stored_file(article['pmcid']) :
+            store_file(article['pmcid'], file['cachepath'])
+    elif SETTINGS['article_store'] and fetch_stored_file(article['pmcid'], file['cachepath']) :
+        DOWNLOAD_LOG.debug("Article file from store: %s", file['cachepath'])
     else:
-        print("Downloading " + file['url'] + " to " + file['cachepath'])
+        take_download_token()
+        DOWNLOAD_LOG.info("Downloading %s to %s", file['url'], file['cachepath'])
         request = urllib.request.Request(file['url'])
         request.add_header('User-Agent','Mozilla/5.0 (Macintosh; U; Intel Mac OS X 10_6_3; en-US) AppleWebKit/534.3 (KHTML, like Gecko) Chrome/6.0.472.53 Safari/534.3')
+        # stream into a temp file and rename it into place, so a partial download never looks like a cached file.
+        fd, partpath = tempfile.mkstemp(suffix='.part', dir=cachepath)
         try:
-            f = urllib.request.urlopen(request)
-            with open(file['cachepath'], "wb") as local_file:
-                local_file.write(f.read())
-
-        except urllib.error.URLError as e:
+            with os.fdopen(fd, "wb") as local_file, urllib.request.urlopen(request, timeout=SETTINGS['download_timeout']) as f:
+                shutil.copyfileobj(f, local_file)
+            os.chmod(partpath, 0o644)
+            os.replace(partpath, file['cachepath'])
+            if SETTINGS['article_store'] :
+                store_file(article['pmcid'], file['cachepath'])
+
+        except OSError as e:
+            os.remove(partpath)
             with open(errorpath, "w") as local_file:
                 local_file.write('Error getting url:\n'+file['url'])
-                local_file.write('Code: ' + str(e.code))
-                local_file.write('Read: ' + str(e.read))
+                local_file.write('Code: ' + str(getattr(e, 'code', '')))
+                local_file.write('Read: ' + str(e))
 
-        time.sleep(random.randint(3, 6))
     if os.path.exists(file['cachepath']):
         article['files'].append(file)
 
 
+def article_store_db():
+    '''Open (once per thread) the index of the article store: pmcid -> sha256 of its pdf.'''
+    db = getattr(ARTICLE_STORE_CONNECTIONS, 'db', None)
+    if db is None :
+        os.makedirs(SETTINGS['article_store'], exist_ok=True)
+        db = ARTICLE_STORE_CONNECTIONS.db = connect_shared_db(os.path.join(SETTINGS['article_store'], 'index.sqlite'))
+        db.execute('CREATE TABLE IF NOT EXISTS articles (pmcid TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, stored REAL, accessed REAL)')
+        db.execute('CREATE INDEX IF NOT EXISTS articles_accessed ON articles (accessed)')
+        db.execute('CREATE INDEX IF NOT EXISTS articles_sha256 ON articles (sha256)')
+    return db
+
+
+def stored_object_path(sha256):
+    return os.path.join(SETTINGS['article_store'], 'objects', sha256[:2], sha256)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f :
+        for block in iter(functools.partial(f.read, 1 << 20), b'') :
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def stored_file(pmcid):
+    '''(sha256, size) of the stored pdf of pmcid, or None.'''
+    return article_store_db().execute('SELECT sha256, size FROM articles WHERE pmcid = ?', (pmcid,)).fetchone()
+
+
+def fetch_stored_file(pmcid, dst):
+    '''Put the stored pdf of pmcid at dst, once it checks out against its checksum. Returns whether it did.'''
+    row = stored_file(pmcid)
+    if row is None :
+        return False
+    sha256, size = row
+    path = stored_object_path(sha256)
+    db = article_store_db()
+    try:
+        if os.path.getsize(path) != size or file_sha256(path) != sha256 :
+            DOWNLOAD_LOG.warning("Dropping corrupt stored file for PMC%s: %s", pmcid, path)
+            os.remove(path)
+            with db :
+                db.execute('DELETE FROM articles WHERE sha256 = ?', (sha256,))
+            return False
+        # the link keeps the file even if the store evicts it later.
+        try:
+            os.link(path, dst)
+        except OSError:
+            shutil.copyfile(path, dst + '.part')
+            os.replace(dst + '.part', dst)
+    except OSError as e:
+        # e.g. evicted by a concurrent run since we looked it up.
+        DOWNLOAD_LOG.info("Stored file for PMC%s unavailable: %s", pmcid, e)
+        return False
+    with db :
+        db.execute('UPDATE articles SET accessed = ? WHERE pmcid = ?', (time.time(), pmcid))
+    return True
+
+
+def store_file(pmcid, path):
+    '''Add a downloaded pdf to the store under its sha256 and index it by pmcid.
+
+    The store is a cache: failing to write it is logged, not raised.'''
+    try:
+        sha256 = file_sha256(path)
+        object_path = stored_object_path(sha256)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        if not os.path.exists(object_path) :
+            try:
+                os.link(path, object_path)
+            except FileExistsError:
+                pass
+            except OSError:
+                # most likely the store is on another filesystem.
+                fd, partpath = tempfile.mkstemp(suffix='.part', dir=os.path.dirname(object_path))
+                with os.fdopen(fd, 'wb') as f, open(path, 'rb') as src :
+                    shutil.copyfileobj(src, f)
+                os.chmod(partpath, 0o644)
+                os.replace(partpath, object_path)
+        now = time.time()
+        with article_store_db() as db :
+            db.execute('INSERT OR REPLACE INTO articles (pmcid, sha256, size, stored, accessed) VALUES (?, ?, ?, ?, ?)',
+                       (pmcid, sha256, os.path.getsize(path), now, now))
+    except (OSError, sqlite3.Error) as e:
+        DOWNLOAD_LOG.warning("Cannot add PMC%s to the article store: %s", pmcid, e)
+
+
+def trim_article_store():
+    '''Drop least recently used pdfs until the store is within its size cap.'''
+    db = article_store_db()
+    limit = SETTINGS['article_store_size'] * 1024 ** 3
+    total = db.execute('SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT sha256, size FROM articles)').fetchone()[0]
+    evicted = 0
+    for pmcid, sha256, size in db.execute('SELECT pmcid, sha256, size FROM articles ORDER BY accessed').fetchall() :
+        if total <= limit :
+            break
+        with db :
+            db.execute('DELETE FROM articles WHERE pmcid = ?', (pmcid,))
+        # identical pdfs under several pmcids share one file.
+        if db.execute('SELECT 1 FROM articles WHERE sha256 = ?', (sha256,)).fetchone() is None :
+            if os.path.exists(stored_object_path(sha256)) :
+                os.remove(stored_object_path(sha256))
+            total -= size
+        evicted += 1
+    if evicted :
+        DOWNLOAD_LOG.info("Evicted %d least recently used files from the article store", evicted)
+
+
 def write_output(batch,batch_out_dir,article,article_number):
+    '''Write the article's import package. Returns the bytes linked rather than copied, none with --archive.'''
     target_collection = get_target_collection_dir(article)
 
     collection_out_dir = os.path.join(batch_out_dir, target_collection)
@@ -779,16 +2236,100 @@ def write_output(batch,batch_out_dir,article,article_number):
     bulklib.write_dash_meta(article,article_out_dir)
     bulklib.write_contents_file(article,article_out_dir)
 
+    saved = 0
     for file in article['files'] :
-        shutil.copyfile(file['cachepath'], os.path.join(article_out_dir, file['name']))
-    shutil.copyfile(os.path.join(DATA_DIR, "licenses", article['license'], 'license.txt'), os.path.join(article_out_dir, 'license.txt'))
+        saved += place_file(file['cachepath'], os.path.join(article_out_dir, file['name']))
+    saved += place_file(os.path.join(DATA_DIR, "licenses", article['license'], 'license.txt'), os.path.join(article_out_dir, 'license.txt'))
+    if SETTINGS['archive'] :
+        archive_article(batch_out_dir, target_collection, article_number)
+        # the archive gets its own copy of every byte, linked into the package directory or not.
+        return 0
+    return saved
+
+
+def archive_article(batch_out_dir, collection, article_number):
+    '''Move a written article package into its collection archive, as <collection>/<number>.'''
+    archive = collection_archive(batch_out_dir, collection)
+    article_out_dir = os.path.join(batch_out_dir, collection, str(article_number))
+    arcname = os.path.join(collection, str(article_number))
+    if SETTINGS['archive'] == 'zip' :
+        for name in sorted(os.listdir(article_out_dir)) :
+            archive['file'].write(os.path.join(article_out_dir, name), os.path.join(arcname, name))
+    else :
+        archive['file'].add(article_out_dir, arcname)
+    shutil.rmtree(article_out_dir)
+
+
+def collection_archive(batch_out_dir, collection):
+    '''The open archive for a collection, started on first use as a .part file.'''
+    archive = OUTPUT_ARCHIVES.get(collection)
+    if archive is None :
+        archive_format = SETTINGS['archive']
+        path = os.path.join(batch_out_dir, collection + '.' + archive_format)
+        OUTPUT_LOG.info("Writing archive: %s", path)
+        if archive_format == 'zip' :
+            streams = []
+            archive_file = zipfile.ZipFile(path + '.part', 'w', zipfile.ZIP_DEFLATED)
+        else :
+            streams = [open(path + '.part', 'wb')]
+            if archive_format == 'tar.zst' :
+                streams.insert(0, zstandard.ZstdCompressor().stream_writer(streams[0]))
+            # stream modes: the archive is only ever appended to. dereference, because tarfile spots hard links by
+            # inode, and the inodes of removed article directories get reused.
+            archive_file = tarfile.open(fileobj=streams[0], mode='w|gz' if archive_format == 'tar.gz' else 'w|', dereference=True)
+        archive = OUTPUT_ARCHIVES[collection] = {'path': path, 'file': archive_file, 'streams': streams}
+    return archive
+
+
+def close_archives(batch_out_dir):
+    '''Finish the collection archives and drop the emptied collection directories.'''
+    for collection, archive in sorted(OUTPUT_ARCHIVES.items()) :
+        archive['file'].close()
+        for stream in archive['streams'] :
+            stream.close()
+        os.replace(archive['path'] + '.part', archive['path'])
+        collection_out_dir = os.path.join(batch_out_dir, collection)
+        if os.path.isdir(collection_out_dir) and not os.listdir(collection_out_dir) :
+            os.rmdir(collection_out_dir)
+    OUTPUT_ARCHIVES.clear()
+
+
+def place_file(src, dst):
+    '''Put src at dst by reflink, hardlink or copy, per link_mode. Returns the bytes not copied.'''
+    mode = SETTINGS['link_mode']
+    if mode in ('reflink', 'auto') :
+        try:
+            reflink_file(src, dst)
+            return os.path.getsize(dst)
+        except OSError as e:
+            OUTPUT_LOG.debug("cannot reflink %s: %s", src, e)
+    if mode in ('hardlink', 'auto') :
+        try:
+            os.link(src, dst)
+            return os.path.getsize(dst)
+        except OSError as e:
+            # most likely source and target are on different filesystems.
+            OUTPUT_LOG.debug("cannot hardlink %s: %s", src, e)
+    shutil.copyfile(src, dst)
+    return 0
+
+
+def reflink_file(src, dst):
+    try:
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file :
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    except OSError:
+        if os.path.exists(dst) :
+            os.remove(dst)
+        raise
 
 
 def prep_batch_out_dir(batch_out_dir):
     if os.path.exists(batch_out_dir):
-        print("Deleting existing batch_out_dir: " + batch_out_dir)
+        LOG.info("Deleting existing batch_out_dir: %s", batch_out_dir)
         shutil.rmtree(batch_out_dir)
-    print("Creating batch_out_dir: " + batch_out_dir)
+    LOG.info("Creating batch_out_dir: %s", batch_out_dir)
     os.mkdir(batch_out_dir)
 
-main()
+if __name__ == '__main__':
+    main()
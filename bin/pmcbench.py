@@ -0,0 +1,306 @@
+#!/bin/env python3
+
+# benchmark pmc2dash on a synthetic batch.
+# generates oai ListRecords pages of pmc_fm records, stubs out bulklib, tsv and the dash
+# getBestMatch service, then runs the pages through pmc2dash's own page pipeline and reports
+# records/sec per metrics.json stage and peak memory.
+# with --harvest the pages are served by a local oai-pmh stand-in and fetched through oaiharvest.
+
+import sys, os
+
+import argparse, json, random, resource, shutil, tempfile, threading, time, types
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BATCH = 'bench'
+
+OAI_NS = 'http://www.openarchives.org/OAI/2.0/'
+ARTICLE_NS = 'https://jats.nlm.nih.gov/ns/archiving/1.3/'
+
+FAS_DEPTS = ['Chemistry and Chemical Biology', 'Molecular and Cellular Biology', 'Organismic and Evolutionary Biology',
+             'Physics', 'Psychology', 'Economics', 'Government', 'Statistics', 'Stem Cell and Regenerative Biology']
+
+HARVARD_AFFS = ['Department of Medicine, Massachusetts General Hospital, Harvard Medical School, Boston, MA, USA',
+                'Department of Epidemiology, Harvard School of Public Health, Boston, MA 02115, USA',
+                'Harvard Graduate School of Education, Cambridge, MA, USA',
+                'Department of Chemistry &amp; Chemical Biology, Harvard University, Cambridge, MA 02138, USA',
+                'Department of Psychology, Harvard University, Cambridge, Massachusetts, United States of America',
+                'Broad Institute of Harvard and MIT, Cambridge, MA, USA']
+
+OTHER_AFFS = ['Department of Biology, University of Somewhere, Springfield, USA',
+              'Institute of Molecular Medicine, Another University, Oxford, UK',
+              'School of Public Health, State University, Chicago, IL, USA. Email: someone@example.edu',
+              'Max Planck Institute for Chemistry, Mainz, Germany']
+
+SURNAMES = ['Smith', 'Chen', 'Garcia', 'Okafor', 'Novak', 'Kumar', 'Rossi', 'Tanaka', 'Haddad', 'Johansson']
+GIVEN_NAMES = ['Anna', 'Wei', 'Maria J', 'Chidi', 'Petr', 'Priya K', 'Luca', 'Yuki', 'Omar', 'Erik A']
+WORDS = ['cell', 'signaling', 'cohort', 'risk', 'protein', 'expression', 'model', 'trial', 'network', 'response',
+         'genome', 'variant', 'outcome', 'neural', 'structure', 'dynamics', 'mouse', 'human', 'analysis', 'pathway']
+
+
+def words(rnd, n):
+    return " ".join(rnd.choice(WORDS) for i in range(n))
+
+
+def generate_record(rnd, pmcid, harvard, authors):
+    '''One OAI record with a JATS pmc_fm article of the given number of authors.'''
+    affs = rnd.sample(OTHER_AFFS, 2)
+    if harvard :
+        affs[rnd.randrange(2)] = rnd.choice(HARVARD_AFFS)
+    contribs = []
+    for i in range(authors) :
+        contribs.append('<contrib contrib-type="author"><name><surname>{}</surname><given-names>{}</given-names></name>'
+                        '<xref ref-type="aff" rid="aff{}">{}</xref></contrib>'.format(rnd.choice(SURNAMES) + str(i), rnd.choice(GIVEN_NAMES), i % 2 + 1, i % 2 + 1))
+    aff_nodes = "".join('<aff id="aff{0}"><label>{0}</label>{1}</aff>'.format(i + 1, aff) for i, aff in enumerate(affs))
+    return ('<record><header><identifier>oai:pubmedcentral.nih.gov:{pmcid}</identifier><datestamp>2017-03-01</datestamp></header>'
+            '<metadata><article xmlns="{ns}" xmlns:xlink="http://www.w3.org/1999/xlink" article-type="research-article"><front>'
+            '<journal-meta><journal-title-group><journal-title>Journal of {journal}</journal-title></journal-title-group>'
+            '<issn pub-type="epub">1234-5678</issn><publisher><publisher-name>Public Library</publisher-name></publisher></journal-meta>'
+            '<article-meta><article-id pub-id-type="pmc-uid">{pmcid}</article-id><article-id pub-id-type="doi">10.1000/bench.{pmcid}</article-id>'
+            '<article-categories><subj-group subj-group-type="heading"><subject>Research Article</subject></subj-group>'
+            '<subj-group subj-group-type="Discipline"><subject>{subject}</subject></subj-group></article-categories>'
+            '<title-group><article-title>{title}</article-title></title-group>'
+            '<contrib-group>{contribs}</contrib-group>{affs}'
+            '<pub-date pub-type="epub"><day>1</day><month>3</month><year>2017</year></pub-date>'
+            '<volume>{volume}</volume><issue>{issue}</issue><elocation-id>e{pmcid}</elocation-id>'
+            '<permissions><copyright-year>2017</copyright-year></permissions>'
+            '<abstract><sec><title>Background</title><p>{abstract1}</p></sec><sec><title>Results</title><p>{abstract2}</p></sec></abstract>'
+            '<kwd-group><kwd>{kwd1}</kwd><kwd>{kwd2}</kwd></kwd-group>'
+            '</article-meta></front></article></metadata></record>').format(
+                ns=ARTICLE_NS, pmcid=pmcid, journal=words(rnd, 2).title(), subject=words(rnd, 1).title(),
+                title=words(rnd, 10).capitalize(), contribs="".join(contribs), affs=aff_nodes,
+                volume=rnd.randint(1, 40), issue=rnd.randint(1, 12), abstract1=words(rnd, 60), abstract2=words(rnd, 60),
+                kwd1=words(rnd, 2), kwd2=words(rnd, 2))
+
+
+def generate_page(path, rnd, first_pmcid, records, harvard_ratio, authors, token):
+    '''Write one ListRecords page. Returns the pmcids of its harvard records.'''
+    harvard_pmcids = []
+    with open(path, 'w', encoding='utf-8') as f :
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<OAI-PMH xmlns="{}"><responseDate>2017-04-01T00:00:00Z</responseDate>'
+                '<request verb="ListRecords">https://www.ncbi.nlm.nih.gov/pmc/oai/oai.cgi</request><ListRecords>'.format(OAI_NS))
+        for i in range(records) :
+            harvard = rnd.random() < harvard_ratio
+            if harvard :
+                harvard_pmcids.append(str(first_pmcid + i))
+            f.write(generate_record(rnd, first_pmcid + i, harvard, authors))
+            f.write("\n")
+        # an empty resumptionToken marks the last page of a harvest.
+        f.write('<resumptionToken>{}</resumptionToken></ListRecords></OAI-PMH>'.format(token))
+    return harvard_pmcids
+
+
+def fill_article_cache(data_dir, pmcids):
+    '''Put a pdf for every harvard record in the batch's article cache, where download_files finds it
+    without going to ncbi: the download stage then times the cache path.'''
+    cache_dir = os.path.join(data_dir, 'batch', BATCH, 'articles')
+    os.makedirs(cache_dir)
+    pdf_path = os.path.join(data_dir, 'bench.pdf')
+    with open(pdf_path, 'wb') as f :
+        f.write(b'%PDF-1.4\n' + b'0' * 100000)
+    for pmcid in pmcids :
+        shutil.copyfile(pdf_path, os.path.join(cache_dir, pmcid + '.pdf'))
+
+
+def install_stubs(data_dir):
+    '''Stand-ins for the bulklib and tsv modules, which live outside this repo.'''
+    bulklib = types.ModuleType('bulklib')
+    bulklib.load_dash2ldap_school = lambda: {'FAS': 'FAS', 'HMS': 'HMS', 'SPH': 'HSPH', 'GSE': 'GSE'}
+    bulklib.load_fas_departments = lambda: list(FAS_DEPTS)
+    bulklib.load_dash_dois = lambda: set()
+    bulklib.load_dash_titles = lambda: set()
+    bulklib.load_dash_pmcids = lambda: set()
+
+    def findit(pattern, text):
+        import re
+        match = re.search(pattern, text)
+        return match.group(1) if match else None
+
+    def write_file(article_out_dir, name, text):
+        with open(os.path.join(article_out_dir, name), 'w', encoding='utf-8') as f :
+            f.write(text)
+
+    bulklib.findit = findit
+    bulklib.write_dublin_core_meta = lambda article, article_out_dir, batch: write_file(article_out_dir, 'dublin_core.xml', article['citation'])
+    bulklib.write_dash_meta = lambda article, article_out_dir: write_file(article_out_dir, 'metadata_dash.xml', article['title'])
+    bulklib.write_contents_file = lambda article, article_out_dir: write_file(article_out_dir, 'contents', "\n".join(f['name'] for f in article['files']))
+    sys.modules['bulklib'] = bulklib
+
+    tsv = types.ModuleType('tsv')
+    tsv.read_map = lambda path: {}
+    sys.modules['tsv'] = tsv
+
+    license_dir = os.path.join(data_dir, 'licenses', 'LAA')
+    os.makedirs(license_dir)
+    with open(os.path.join(license_dir, 'license.txt'), 'w') as f :
+        f.write("license\n")
+
+
+def start_authority_service(match_ratio, seed):
+    '''Local getBestMatch stand-in replaying canned choices json. Returns (url, server).'''
+    rnd = random.Random(seed)
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body go out as separate writes; without this nagle stalls every keep-alive response.
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            with lock :
+                matched = rnd.random() < match_ratio
+            choices = []
+            if matched :
+                choices.append({'authority': 'huid-' + query['surname'][0], 'label': query['surname'][0], 'confidence': 0.9, 'schools': ['FAS']})
+            body = json.dumps({'choices': choices}).encode('ISO-8859-1')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}/getBestMatch'.format(server.server_address[1]), server
+
+
+def start_oai_service(oai_files):
+    '''Local oai-pmh stand-in serving the generated pages, resumptionToken pageN for the nth page. Returns (url, server).'''
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            token = query.get('resumptionToken', ['page0'])[0]
+            with open(oai_files[int(token[len('page'):])], 'rb') as f :
+                body = f.read()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/xml')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}/oai?verb=ListRecords&metadataPrefix=pmc_fm'.format(server.server_address[1]), server
+
+
+def run_pipeline(pmc2dash, oai_files, metrics, report):
+    '''Run pmc2dash's page pipeline over the synthetic pages, as its main loop does in one process:
+    process_page, then load_page_articles. Stage seconds add up in metrics, the pmc2dash counters in report.
+
+    The wait for each next page is timed as harvest, which only takes time with --harvest.'''
+    batch_out_dir = os.path.join(pmc2dash.DATA_DIR, 'batch', BATCH, 'import')
+    pmc2dash.prep_batch_out_dir(batch_out_dir)
+    classifier = pmc2dash.build_school_classifier(FAS_DEPTS)
+    dash_index = pmc2dash.load_dash_index()
+    article_number = 0
+    for oai_file in pmc2dash.timed_iter(metrics, 'harvest', oai_files) :
+        page = pmc2dash.process_page(oai_file, classifier)
+        article_numbers, holdings, fingerprints = pmc2dash.load_page_articles(BATCH, batch_out_dir, page, dash_index, article_number)
+        article_number += len(article_numbers)
+        pmc2dash.merge_report(report, page['report'])
+        pmc2dash.merge_metrics(metrics, page['metrics'])
+    pmc2dash.close_archives(batch_out_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''Benchmark pmc2dash stages on a synthetic batch of pmc_fm records.''')
+    parser.add_argument('--pages', type=int, default=2, help='oai pages to generate (default: %(default)s)')
+    parser.add_argument('--records', type=int, default=1000, help='records per page (default: %(default)s)')
+    parser.add_argument('--harvard-ratio', type=float, default=0.05, help='share of records with a harvard affiliation (default: %(default)s)')
+    parser.add_argument('--authors', type=int, default=6, help='authors per record (default: %(default)s)')
+    parser.add_argument('--match-ratio', type=float, default=0.5, help='share of author lookups the stub service matches (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed, for repeatable corpora (default: %(default)s)')
+    parser.add_argument('--extractor', default='xpath', choices=('xpath', 'single-pass'), help='pmc2dash record extractor to benchmark (default: %(default)s)')
+    parser.add_argument('--harvest', action='store_true', help='serve the pages from a local oai-pmh stand-in and harvest them with oaiharvest, timing the harvest too')
+    parser.add_argument('--json', metavar='PATH', help='also write the results as json to PATH')
+    parser.add_argument('--verbose', action='store_true', help='show pmc2dash debug logging instead of warnings only')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='pmcbench.') as work_dir :
+        # pmc2dash finds its data directory through OSCROOT at import time.
+        os.environ['OSCROOT'] = work_dir
+        data_dir = os.path.join(work_dir, 'proj/pmc/data')
+        install_stubs(data_dir)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import pmc2dash
+
+        authority_url, server = start_authority_service(args.match_ratio, args.seed)
+        pmc2dash.SETTINGS['authority_url'] = authority_url
+        pmc2dash.SETTINGS['authority_cache'] = None
+        pmc2dash.SETTINGS['article_store'] = None
+        pmc2dash.SETTINGS['batch'] = BATCH
+        pmc2dash.SETTINGS['extractor'] = args.extractor
+        pmc2dash.SETTINGS['log_level'] = 'DEBUG' if args.verbose else 'WARNING'
+        pmc2dash.configure_logging()
+
+        rnd = random.Random(args.seed)
+        oai_dir = os.path.join(work_dir, 'oai')
+        os.mkdir(oai_dir)
+        oai_files = []
+        harvard_pmcids = []
+        for page in range(args.pages) :
+            oai_file = os.path.join(oai_dir, 'page{:04d}.xml'.format(page))
+            token = 'page{}'.format(page + 1) if page + 1 < args.pages else ''
+            harvard_pmcids.extend(generate_page(oai_file, rnd, 100000 + page * args.records, args.records, args.harvard_ratio, args.authors, token))
+            oai_files.append(oai_file)
+        corpus_bytes = sum(os.path.getsize(oai_file) for oai_file in oai_files)
+        fill_article_cache(data_dir, harvard_pmcids)
+
+        pages = oai_files
+        if args.harvest :
+            oai_url, oai_server = start_oai_service(oai_files)
+            pages = pmc2dash.oaiharvest.harvest_pages(oai_url, os.path.join(work_dir, 'harvest'))
+
+        # the metrics.json stages, page_parse including the byte prescreen and prescreen the full aff check.
+        stages = (('harvest',) if args.harvest else ()) + pmc2dash.STAGES
+        metrics = pmc2dash.init_metrics()
+        metrics['seconds']['harvest'] = 0.0
+        metrics['calls']['harvest'] = 0
+        report = pmc2dash.init_report(BATCH)
+        start = time.perf_counter()
+        run_pipeline(pmc2dash, pages, metrics, report)
+        elapsed = time.perf_counter() - start
+        server.shutdown()
+        if args.harvest :
+            oai_server.shutdown()
+
+    # records each stage actually saw.
+    records, harvard, written = report['articles_total'], report['articles_harvard'], report['articles_loaded']
+    stage_records = {'harvest': records, 'page_parse': records, 'prescreen': records, 'extraction': harvard,
+                     'school_assignment': harvard, 'authority_lookup': harvard,
+                     'download': written + report['articles_error_no_files'], 'output_write': written}
+    results = {'corpus': {'pages': args.pages, 'records': records, 'harvard': harvard, 'written': written,
+                          'bytes': corpus_bytes, 'authors': args.authors, 'harvard_ratio': args.harvard_ratio, 'seed': args.seed},
+               'stages': {stage: {'seconds': round(metrics['seconds'][stage], 4),
+                                  'records': stage_records[stage],
+                                  'records_per_sec': round(stage_records[stage] / metrics['seconds'][stage], 1) if metrics['seconds'][stage] else None}
+                          for stage in stages},
+               'total_seconds': round(elapsed, 4),
+               'records_per_sec': round(records / elapsed, 1),
+               # ru_maxrss is in kilobytes on linux.
+               'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+    print("{:<26}{:>10}{:>10}{:>14}".format('stage', 'seconds', 'records', 'records/sec'))
+    for stage in stages :
+        result = results['stages'][stage]
+        print("{:<26}{:>10.3f}{:>10}{:>14}".format(stage, result['seconds'], result['records'], result['records_per_sec'] or '-'))
+    print("total: {} records in {:.3f}s ({} records/sec), peak rss {} MB".format(
+        records, elapsed, results['records_per_sec'], results['peak_rss_mb']))
+    if args.json :
+        with open(args.json, 'w') as f :
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()